@@ -0,0 +1,3 @@
+"""Benchmarks for the Entangled filters, run on synthetic literate documents.
+
+Run with `python -m bench.run`; see `python -m bench.run --help`."""
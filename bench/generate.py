@@ -0,0 +1,73 @@
+"""Generates synthetic literate documents."""
+from dataclasses import (dataclass, asdict)
+from typing import (List, Dict, Any)
+
+
+@dataclass
+class Params:
+    blocks: int = 100        # number of named code blocks
+    fanout: int = 2          # references in every fragment
+    depth: int = 3           # depth of the reference tree under every file
+    lines: int = 8           # lines of code in every block
+    suites: int = 0          # number of doctest suites
+    tests: int = 5           # tests in every suite
+    output_size: int = 100   # characters printed by every test
+    inject: int = 0          # number of `inject` blocks
+    fold_every: int = 4      # mark every n-th block with `.bootstrap-fold`
+
+    def to_json(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+def code_block(attributes: str, lines: List[str]) -> str:
+    return "``` {" + attributes + "}\n" + "\n".join(lines) + "\n```\n"
+
+
+def fragment_tree(params: Params, tree: int, start: int) -> List[str]:
+    """Generates the blocks of one file, with at most `params.blocks - start`
+    blocks. The file references `fanout` fragments, each of which references
+    `fanout` fragments, and so on, up to `depth` levels."""
+    blocks: List[str] = []
+    todo = [(f"file{tree}", 0)]
+    count = start
+    while todo and count < params.blocks:
+        name, level = todo.pop(0)
+        children = [] if level >= params.depth else \
+            [f"{name}-{i}" for i in range(params.fanout)]
+        children = children[:max(0, params.blocks - count - len(todo) - 1)]
+        todo.extend((child, level + 1) for child in children)
+        lines = [f"    x_{count}_{i} = {i} * {count}  # {name}" for i in range(params.lines)]
+        body = [f"def {name.replace('-', '_')}():"] + lines \
+            + [f"    <<{child}>>" for child in children]
+        attributes = f".python file={name}.py" if level == 0 else f".python #{name}"
+        if params.fold_every and count % params.fold_every == params.fold_every - 1:
+            attributes = ".bootstrap-fold " + attributes
+        blocks.append(f"Fragment `{name}` at level {level}.\n\n" + code_block(attributes, body))
+        count += 1
+    return blocks
+
+
+def generate(params: Params) -> str:
+    """Generates a literate Markdown document."""
+    parts = ["---\ntitle: Synthetic document\n---\n"]
+    count = 0
+    tree = 0
+    while count < params.blocks:
+        blocks = fragment_tree(params, tree, count)
+        parts.append(f"# File {tree}\n")
+        parts.extend(blocks)
+        count += len(blocks)
+        tree += 1
+
+    for s in range(params.suites):
+        parts.append(f"# Suite {s}\n")
+        parts.append(code_block(f".python #suite{s}", [f"n = {s}"]))
+        for t in range(params.tests):
+            parts.append(code_block(f".python .eval #suite{s}",
+                                    [f"print('{t % 10}' * {params.output_size})"]))
+
+    for i in range(params.inject):
+        parts.append(f"# Injection {i}\n")
+        parts.append(code_block(f".js #inject{i} inject=true",
+                                [f"console.log({i});"] * params.lines))
+    return "\n".join(parts)
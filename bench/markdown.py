@@ -0,0 +1,99 @@
+"""Compares tangling through Pandoc with tangling by `pandoc-tangle-md`, on
+synthetic documents. Both should write exactly the same files."""
+from contextlib import (redirect_stderr)
+from dataclasses import (replace)
+from typing import (Dict, List, Optional, Any)
+from pathlib import (Path)
+
+import argparse
+import gc
+import io
+import json
+import subprocess
+import sys
+import time
+
+from pandoc_entangled import (tangle)
+from pandoc_entangled.document import (load_document)
+from pandoc_entangled.markdown import (read_code_map)
+from panflute import (Doc)
+
+from .generate import (Params, generate)
+from .run import (workdir)
+
+sizes = [Params(blocks=1000), Params(blocks=5000), Params(blocks=1000, lines=200)]
+
+
+def tangle_pandoc(source: Path) -> None:
+    ast = subprocess.run(["pandoc", "-f", "markdown", "-t", "json", str(source)],
+                         capture_output=True, check=True).stdout
+    doc = load_document(io.BytesIO(ast))
+    tangle.prepare(doc)
+    doc.walk(tangle.action)
+    tangle.write_files(doc)
+
+
+def tangle_markdown(source: Path) -> None:
+    doc = Doc()
+    doc.code_map = read_code_map([source])
+    tangle.write_files(doc)
+
+
+def tangled_files(path: Path) -> Dict[str, bytes]:
+    return {p.name: p.read_bytes() for p in path.glob("*.py")}
+
+
+def run_case(params: Params, config: Path, repeat: int) -> Dict[str, Any]:
+    text = generate(params)
+    times: Dict[str, float] = {}
+    outputs = []
+    for name, method in [("pandoc", tangle_pandoc), ("markdown", tangle_markdown)]:
+        best = None
+        for _ in range(repeat):
+            with workdir(config) as path:
+                source = path / "source.md"
+                source.write_text(text)
+                gc.collect()
+                with redirect_stderr(io.StringIO()):
+                    start = time.perf_counter()
+                    method(source)
+                    elapsed = time.perf_counter() - start
+                files = tangled_files(path)
+            best = elapsed if best is None else min(best, elapsed)
+        times[name] = best or 0.0
+        outputs.append(files)
+    if outputs[0] != outputs[1]:
+        raise AssertionError(f"different output for {params}")
+    return {"params": params.to_json(), "bytes": len(text.encode("utf-8")),
+            "files": len(outputs[0]), "time": times}
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Compare tangling with and without Pandoc.")
+    parser.add_argument("--quick", action="store_true", help="run small documents only")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case (default: 3)")
+    parser.add_argument("--output", type=Path, help="write the results to this file")
+    parser.add_argument("--config", type=Path, default=Path("entangled.json"),
+                        help="configuration to use (default: entangled.json)")
+    args = parser.parse_args(argv)
+
+    cases = [replace(p, blocks=min(p.blocks, 50), lines=min(p.lines, 10)) for p in sizes] \
+        if args.quick else sizes
+    results = []
+    for params in cases:
+        result = run_case(params, args.config.resolve(), 1 if args.quick else args.repeat)
+        t = result["time"]
+        print(f"{result['bytes'] / 2**20:8.2f}MB  pandoc {t['pandoc']:8.3f}s  "
+              f"markdown {t['markdown']:8.3f}s  {t['pandoc'] / t['markdown']:6.1f}x",
+              file=sys.stderr)
+        results.append(result)
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
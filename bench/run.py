@@ -0,0 +1,187 @@
+"""Runs the filters on synthetic documents, and reports time and peak memory
+of every phase as JSON."""
+from dataclasses import (dataclass, replace)
+from typing import (Dict, List, Optional, Any, Iterator)
+from contextlib import (contextmanager)
+from pathlib import (Path)
+from shutil import (copyfile)
+
+import argparse
+import datetime
+import gc
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+
+from pandoc_entangled.document import (load_document, dump_document)
+from pandoc_entangled.main import (run)
+from pandoc_entangled.timing import (Timing)
+
+from .generate import (Params, generate)
+
+
+@dataclass
+class Case:
+    name: str
+    filters: List[str]
+    params: Params
+    repeat: int = 3
+
+
+cases = [
+    Case("tangle", ["tangle"], Params(blocks=1000)),
+    Case("tangle-wide", ["tangle"], Params(blocks=1000, fanout=30, depth=2)),
+    Case("tangle-deep", ["tangle"], Params(blocks=1000, fanout=1, depth=50)),
+    Case("tangle-long-blocks", ["tangle"], Params(blocks=200, lines=500)),
+    Case("annotate", ["annotate"], Params(blocks=1000)),
+    Case("bootstrap", ["bootstrap"], Params(blocks=1000)),
+    Case("inject", ["inject"], Params(blocks=200, inject=200)),
+    Case("doctest", ["doctest"], Params(blocks=10, suites=4, tests=50), repeat=1),
+    Case("doctest-output", ["doctest"],
+         Params(blocks=10, suites=1, tests=5, output_size=2**20), repeat=1),
+    Case("combined", ["tangle", "doctest", "bootstrap", "inject"],
+         Params(blocks=1000, suites=2, tests=20, inject=50), repeat=1),
+]
+
+phases = ["load", "collect", "prepare", "action", "finalize", "dump"]
+
+
+def quick(case: Case) -> Case:
+    """A small version of `case`, to check that the benchmarks work."""
+    p = case.params
+    params = replace(p, blocks=min(p.blocks, 20), suites=min(p.suites, 1), tests=min(p.tests, 2),
+                     output_size=min(p.output_size, 1000), inject=min(p.inject, 2),
+                     lines=min(p.lines, 10), depth=min(p.depth, 5), fanout=min(p.fanout, 3))
+    return replace(case, params=params, repeat=1)
+
+
+def run_filters(names: List[str], ast: bytes) -> Dict[str, float]:
+    """Runs the filters in `names` on `ast`, and returns the time spent in
+    every phase, as recorded by `pandoc_entangled.timing`."""
+    timing = Timing()
+    with timing.phase("load"):
+        doc = load_document(io.BytesIO(ast), format="html5")
+    doc.timing = timing
+    doc = run(doc, names)
+    with timing.phase("dump"):
+        dump_document(doc, io.BytesIO())
+    times: Dict[str, float] = {}
+    for name, t in timing.phases.items():
+        phase = {"actions": "action"}.get(name, name.split(".")[0])
+        if phase in phases:
+            times[phase] = times.get(phase, 0.0) + t
+    return times
+
+
+@contextmanager
+def workdir(config: Path) -> Iterator[Path]:
+    """A fresh working directory, with its own cache and a copy of the configuration."""
+    cwd = Path.cwd()
+    env = dict(os.environ)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp)
+        copyfile(config, path / "entangled.json")
+        os.environ["ENTANGLED_CACHE_DIR"] = str(path / ".entangled")
+        os.environ["ENTANGLED_DOCTEST_CACHE"] = "off"
+        os.chdir(path)
+        try:
+            yield path
+        finally:
+            os.chdir(cwd)
+            os.environ.clear()
+            os.environ.update(env)
+
+
+def to_ast(markdown: str) -> bytes:
+    return subprocess.run(["pandoc", "-f", "markdown", "-t", "json"], input=markdown.encode("utf-8"),
+                          capture_output=True, check=True).stdout
+
+
+def run_case(case: Case, config: Path) -> Dict[str, Any]:
+    ast = to_ast(generate(case.params))
+    best: Dict[str, float] = {}
+    for _ in range(case.repeat):
+        with workdir(config):
+            gc.collect()
+            times = run_filters(case.filters, ast)
+            times["total"] = sum(times.values())
+        if not best or times["total"] < best["total"]:
+            best = times
+
+    with workdir(config):
+        gc.collect()
+        tracemalloc.start()
+        try:
+            run_filters(case.filters, ast)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    return {"name": case.name, "filters": case.filters, "params": case.params.to_json(),
+            "repeat": case.repeat, "ast_bytes": len(ast),
+            "time": {phase: best.get(phase, 0.0) for phase in phases + ["total"]},
+            "peak_memory": peak}
+
+
+def report(results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    from pandoc_entangled import __version__
+    return {"version": __version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "cases": results}
+
+
+def compare(old: Dict[str, Any], new: Dict[str, Any]) -> None:
+    """Prints the change in total time and peak memory with respect to an earlier report."""
+    before = {case["name"]: case for case in old["cases"]}
+    for case in new["cases"]:
+        if case["name"] not in before:
+            continue
+        b = before[case["name"]]
+        print(f"{case['name']:20} time {case['time']['total'] / b['time']['total']:6.2f}x  "
+              f"memory {case['peak_memory'] / max(1, b['peak_memory']):6.2f}x", file=sys.stderr)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the Entangled filters.")
+    parser.add_argument("cases", nargs="*", help="cases to run (default: all): "
+                        + ", ".join(case.name for case in cases))
+    parser.add_argument("--quick", action="store_true", help="run small versions of the cases")
+    parser.add_argument("--output", type=Path, help="write the report to this file")
+    parser.add_argument("--compare", type=Path, help="compare with an earlier report")
+    parser.add_argument("--config", type=Path, default=Path("entangled.json"),
+                        help="configuration to use (default: entangled.json)")
+    args = parser.parse_args(argv)
+
+    selected = [case for case in cases if not args.cases or case.name in args.cases]
+    unknown = set(args.cases) - {case.name for case in cases}
+    if unknown:
+        parser.error(f"unknown cases: {', '.join(sorted(unknown))}")
+    if args.quick:
+        selected = [quick(case) for case in selected]
+
+    results = []
+    for case in selected:
+        result = run_case(case, args.config.resolve())
+        print(f"{case.name:20} {result['time']['total']:8.3f}s "
+              f"{result['peak_memory'] / 2**20:8.1f}MB", file=sys.stderr)
+        results.append(result)
+
+    data = report(results)
+    if args.output:
+        args.output.write_text(json.dumps(data, indent=2))
+    else:
+        json.dump(data, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        compare(json.loads(args.compare.read_text()), data)
+
+
+if __name__ == "__main__":
+    main()
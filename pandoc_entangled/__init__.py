@@ -1,5 +1,8 @@
 # ~\~ language=Python filename=pandoc_entangled/__init__.py
 # ~\~ begin <<lit/entangled-python.md|pandoc_entangled/__init__.py>>[init]
-from importlib import metadata
-__version__ = metadata.version("pandoc-entangled")
+def __getattr__(name: str) -> str:
+    if name == "__version__":
+        from importlib import metadata
+        return metadata.version("pandoc-entangled")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 # ~\~ end
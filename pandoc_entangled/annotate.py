@@ -2,7 +2,8 @@
 # ~\~ begin <<lit/filters.md|pandoc_entangled/annotate.py>>[init]
 from collections import defaultdict
 from .tangle import get_name
-from panflute import (Span, Str, Para, CodeBlock, Div, Emph, Doc, run_filter)
+from panflute import (Span, Str, Para, CodeBlock, Div, Emph, Doc)
+from .document import (run_filters)
 from typing import (Optional)
 
 def prepare(doc):
@@ -21,5 +22,5 @@ def action(elem, doc):
         return Div(Para(label), elem, classes=["annotated-code"])
 
 def main(doc: Optional[Doc] = None) -> None:
-    return run_filter(action, prepare=prepare)
+    run_filters([action], prepare=prepare, doc=doc)
 # ~\~ end
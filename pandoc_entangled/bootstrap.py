@@ -1,19 +1,24 @@
 # ~\~ language=Python filename=pandoc_entangled/bootstrap.py
 # ~\~ begin <<lit/filters.md|pandoc_entangled/bootstrap.py>>[init]
 from panflute import (Element, Doc, Plain, CodeBlock, Div, Str, Image, Header,
-                      Link, convert_text, run_filters, RawBlock, Space, LineBreak, MetaInlines)
-from typing import (Optional)
+                      Link, convert_text, RawBlock, Space, LineBreak, MetaInlines)
+from panflute.elements import (from_json)
+from typing import (Optional, List, Dict, Iterable)
 from pathlib import (Path)
 
 import subprocess
-import pkg_resources
 import json
+import re
 
 from .typing import (JSONType)
 from .tangle import get_name
+from .cache import (Store, cache_path)
+from .config import (dhall_key)
+from .document import (run_filters)
+from .timing import (get_timing)
 from . import annotate
 
-data_path = Path(pkg_resources.resource_filename(__name__, "."))
+data_path = Path(__file__).parent
 
 def parse_dhall(content: str, cwd: Optional[Path] = None) -> JSONType:
     """Takes Dhall content and parses it to JSON compatible data."""
@@ -24,15 +29,93 @@ def parse_dhall(content: str, cwd: Optional[Path] = None) -> JSONType:
         stderr=subprocess.PIPE, encoding="utf-8", check=True)
     return json.loads(result.stdout)
 
+# ~\~ begin <<lit/filters.md|bootstrap-parse-dhall-batch>>[init]
+def parse_dhall_batch(contents: List[str], cwd: Optional[Path] = None) -> List[JSONType]:
+    """Parses a list of Dhall expressions to JSON compatible data, using a single
+    call to `dhall-to-json` for all expressions that are not cached."""
+    cwd = cwd or Path(".")
+    store = Store(cache_path("dhall"), 2**24)
+    results: Dict[str, JSONType] = {}
+    todo: Dict[str, Optional[str]] = {}
+    for content in contents:
+        if content in results or content in todo:
+            continue
+        key = dhall_key(content, cwd)
+        cached = store.get(key) if key is not None else None
+        if cached is not None:
+            results[content] = cached["value"]
+        else:
+            todo[content] = key
+
+    if todo:
+        fields = {f"deck{i}": content for i, content in enumerate(todo)}
+        record = "{ " + "\n, ".join(f"{name} =\n(\n{content}\n)"
+                                    for name, content in fields.items()) + "\n}"
+        try:
+            values = parse_dhall(record, cwd=cwd)
+        except subprocess.CalledProcessError:
+            values = {name: parse_dhall(content, cwd=cwd) for name, content in fields.items()}
+        for name, content in fields.items():
+            results[content] = values[name]
+            key = todo[content]
+            if key is not None:
+                store.put(key, {"value": values[name]})
+
+    return [results[content] for content in contents]
+
+
+def collect_card_deck(elem: Element, doc: Doc) -> None:
+    if isinstance(elem, CodeBlock) and "bootstrap-card-deck" in elem.classes:
+        doc.card_deck_sources.append(elem.text)
+
+
+def prepare_card_decks(doc: Doc) -> None:
+    if not hasattr(doc, "card_deck_sources"):
+        doc.card_deck_sources = []
+        doc.walk(collect_card_deck)
+    decks = doc.card_deck_sources
+    with get_timing(doc).phase("bootstrap.dhall"):
+        doc.card_decks = dict(zip(decks, parse_dhall_batch(decks, cwd=data_path)))
+    with get_timing(doc).phase("bootstrap.card-text"):
+        doc.card_texts = convert_card_texts(
+            card["text"] for deck in doc.card_decks.values() for card in deck
+            if isinstance(card, dict) and "text" in card)
+# ~\~ end
+# ~\~ begin <<lit/filters.md|bootstrap-convert-card-texts>>[init]
+isolated_text = re.compile(
+    r"^ {0,3}(#{1,6}([ \t]|$)|=+[ \t]*$|-+[ \t]*$|\[[^\]]+\]:)|\[\^|\(@", re.MULTILINE)
+
+def convert_card_texts(texts: Iterable[str]) -> Dict[str, str]:
+    """Converts Markdown texts with a single call to `pandoc`. Returns the
+    blocks of every distinct text, as Pandoc JSON. Texts with headers,
+    reference definitions, footnotes or example lists are left out."""
+    unique = [t for t in dict.fromkeys(texts) if not isolated_text.search(t)]
+    if not unique:
+        return {}
+    fence = ":" * max([3] + [len(m) + 1 for t in unique for m in re.findall(":{3,}", t)])
+    source = "\n\n".join(f"{fence} {{#card-text-{i}}}\n{text}\n{fence}"
+                          for i, text in enumerate(unique))
+    blocks = {block["c"][0][0]: block["c"][1]
+              for block in json.loads(convert_text(source, output_format="json"))["blocks"]
+              if block["t"] == "Div"}
+    return {text: json.dumps(blocks[f"card-text-{i}"])
+            for i, text in enumerate(unique) if f"card-text-{i}" in blocks}
+# ~\~ end
 # ~\~ begin <<lit/filters.md|bootstrap-card-deck>>[init]
 def bootstrap_card_deck(elem: Element, doc: Doc) -> Optional[Element]:
     def outer_container(*elements: Element):
         return Div(Div(*elements, classes=["card-deck"]), classes=["container-fluid", "my-4"])
 
+    def card_text(text: str) -> List[Element]:
+        converted = getattr(doc, "card_texts", {}).get(text)
+        if converted is None:
+            return convert_text(text)
+        return json.loads(converted, object_hook=from_json)
+
     def horizontal_card(card_data: JSONType) -> Element:
         assert "title" in card_data and "text" in card_data
         title = card_data["title"]
-        text = convert_text(card_data["text"])
+        text = card_text(card_data["text"])
 
         content = []
         body = [
@@ -57,7 +140,7 @@ def bootstrap_card_deck(elem: Element, doc: Doc) -> Optional[Element]:
     def vertical_card(card_data: JSONType) -> Element:
         assert "title" in card_data and "text" in card_data
         title = card_data["title"]
-        text = convert_text(card_data["text"])
+        text = card_text(card_data["text"])
 
         content = []
         if "image" in card_data:
@@ -85,7 +168,9 @@ def bootstrap_card_deck(elem: Element, doc: Doc) -> Optional[Element]:
             return horizontal_card(card_data)
 
     if isinstance(elem, CodeBlock) and "bootstrap-card-deck" in elem.classes:
-        deck_data = parse_dhall(elem.text, cwd=data_path)
+        deck_data = getattr(doc, "card_decks", {}).get(elem.text)
+        if deck_data is None:
+            deck_data = parse_dhall(elem.text, cwd=data_path)
         content = map(card, deck_data)
         return outer_container(*content)
 
@@ -131,6 +216,7 @@ def prepare(doc: Doc) -> Doc:
         return islice(chain.from_iterable(zip(repeat(delimiter), seq)), 1, None)
 
     annotate.prepare(doc)
+    prepare_card_decks(doc)
 
     if "footer" in doc.metadata:
         content = [[Str(str(date.today()))]]
@@ -0,0 +1,82 @@
+# ~\~ language=Python filename=pandoc_entangled/cache.py
+# ~\~ begin <<lit/filters.md|pandoc_entangled/cache.py>>[init]
+from pathlib import (Path)
+from typing import (Optional)
+from .typing import (JSONType)
+
+import hashlib
+import json
+import os
+
+def cache_path(*parts: str) -> Path:
+    """Returns a path inside the cache directory."""
+    return Path(os.environ.get("ENTANGLED_CACHE_DIR", ".entangled")).joinpath(*parts)
+
+def content_hash(*parts: str) -> str:
+    """Hashes a sequence of strings, such that the boundaries between
+    the parts matter."""
+    h = hashlib.sha256()
+    for part in parts:
+        data = part.encode("utf-8")
+        h.update(len(data).to_bytes(8, "little"))
+        h.update(data)
+    return h.hexdigest()
+
+def read_json(path: Path) -> Optional[JSONType]:
+    """Reads JSON from `path`, returning `None` if the file does not exist or
+    cannot be read."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_json(path: Path, data: JSONType) -> None:
+    """Writes `data` to `path` as JSON. The file is replaced atomically, so
+    that concurrent readers never see a partial file."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+# ~\~ begin <<lit/filters.md|cache-store>>[init]
+class Store:
+    """A directory of JSON entries with least-recently-used eviction."""
+    def __init__(self, path: Path, max_size: int):
+        self.path = path
+        self.max_size = max_size
+
+    def _entry(self, key: str) -> Path:
+        return self.path / f"{key}.json"
+
+    def get(self, key: str) -> Optional[JSONType]:
+        entry = self._entry(key)
+        data = read_json(entry)
+        if data is not None:
+            try:
+                os.utime(entry)
+            except OSError:
+                pass
+        return data
+
+    def put(self, key: str, data: JSONType) -> None:
+        write_json(self._entry(key), data)
+        self.evict()
+
+    def evict(self) -> None:
+        entries = []
+        for entry in self.path.glob("*.json"):
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, entry))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            entry.unlink(missing_ok=True)
+            total -= size
+# ~\~ end
+# ~\~ end
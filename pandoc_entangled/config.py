@@ -1,32 +1,119 @@
 # ~\~ language=Python filename=pandoc_entangled/config.py
 # ~\~ begin <<lit/filters.md|pandoc_entangled/config.py>>[init]
+from panflute import (Doc)
+from pathlib import (Path)
+from typing import (TypeVar, Dict, Optional)
 from .typing import (JSONType)
+from .cache import (cache_path, content_hash, read_json, write_json)
 import subprocess
 import json
 import sys
 
-def read_config() -> JSONType:
+# ~\~ begin <<lit/filters.md|config-class>>[init]
+class Config(dict):
+    """The configuration, with an index of languages by identifier."""
+    _languages: Optional[Dict[str, JSONType]] = None
+
+    @property
+    def languages(self) -> Dict[str, JSONType]:
+        if self._languages is None:
+            kernels = { k["language"]: k["kernel"] for k in self["jupyter"] }
+            index: Dict[str, JSONType] = {}
+            for lang in self["entangled"]["languages"]:
+                info = {"jupyter": kernels.get(lang["name"]), **lang}
+                for identifier in lang["identifiers"]:
+                    index.setdefault(identifier, info)
+            self._languages = index
+        return self._languages
+# ~\~ end
+# ~\~ begin <<lit/filters.md|config-cache>>[init]
+import os
+import re
+
+dhall_import_pattern = re.compile(
+    r"(?<![\w:.\-/])(?P<local>(?:\.\.?|~)?/(?![/\\\s])[^\s()\[\]{},]+)"
+    r"|(?P<remote>https?://[^\s()\[\]{},]+)(?P<pinned>\s+sha256:)?"
+    r"|\benv:(?P<env>[A-Za-z_][A-Za-z0-9_]*)")
+
+def dhall_key(text: str, cwd: Path) -> Optional[str]:
+    """Computes a hash of the Dhall expression `text` and everything it imports,
+    relative to `cwd`. Returns `None` if the result cannot be cached, because of
+    an unprotected remote import."""
+    parts = [text]
+    seen = set()
+    todo = [(cwd, text)]
+    while todo:
+        base, content = todo.pop()
+        for m in dhall_import_pattern.finditer(content):
+            if m["local"]:
+                local = m["local"]
+                target = Path(os.path.normpath(
+                    Path(local).expanduser() if local.startswith("~") else base / local))
+                if target in seen:
+                    continue
+                seen.add(target)
+                try:
+                    imported = target.read_text(encoding="utf-8")
+                except OSError:
+                    imported = ""
+                parts.extend([str(target), imported])
+                todo.append((target.parent, imported))
+            elif m["remote"] and not m["pinned"]:
+                return None
+            elif m["env"]:
+                parts.extend([m["env"], os.environ.get(m["env"], "")])
+    return content_hash(*parts)
+# ~\~ end
+
+def read_config() -> "Config":
     """Reads config from `entangled.dhall` with fall-back to `entangled.json`."""
+    dhall = Path("entangled.dhall")
+    if not dhall.exists():
+        return Config(json.load(open("entangled.json", "r")))
+    key = dhall_key(dhall.read_text(encoding="utf-8"), dhall.parent)
+    cached = read_json(cache_path("config.json"))
+    if key is not None and cached is not None and cached.get("key") == key:
+        return Config(cached["config"])
     try:
         result = subprocess.run(
-            ["dhall-to-json", "--file", "entangled.dhall"],
+            ["dhall-to-json", "--file", str(dhall)],
             stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8', check=True)
-        return json.loads(result.stdout)
+        config = json.loads(result.stdout)
+        if key is not None:
+            try:
+                write_json(cache_path("config.json"), {"key": key, "config": config})
+            except OSError:
+                pass
+        return Config(config)
     except subprocess.CalledProcessError as e:
         print("Error reading `entangled.dhall`:\n" + e.stderr, file=sys.stderr)
     except FileNotFoundError:
         print("Warning: could not find `dhall-to-json`, trying to read JSON instead.",
               file=sys.stderr)
-    return json.load(open("entangled.json", "r"))
+    return Config(json.load(open("entangled.json", "r")))
 
 def get_language_info(config: JSONType, identifier: str) -> JSONType:
-    kernels = { k["language"]: k["kernel"] for k in config["jupyter"] }
-
+    if not isinstance(config, Config):
+        config = Config(config)
     try:
-        language = next(lang for lang in config["entangled"]["languages"]
-                        if identifier in lang["identifiers"])
-    except StopIteration:
+        return config.languages[identifier]
+    except KeyError:
         raise ValueError(f"Language with identifier `{identifier}` not found in config.")
 
-    return {"jupyter": kernels.get(language["name"]), **language}
+# ~\~ begin <<lit/filters.md|config-settings>>[init]
+T = TypeVar("T")
+
+def get_setting(doc: Doc, section: str, key: str, default: T) -> T:
+    """Looks up setting `section.key` in the document metadata, and then
+    in `doc.config`. Returns `default` if the setting is not found."""
+    value = doc.get_metadata(f"{section}.{key}", None)
+    if value is None:
+        config = getattr(doc, "config", None) or {}
+        value = (config.get(section) or {}).get(key)
+    if value is None:
+        return default
+    if isinstance(default, bool) and isinstance(value, str):
+        return value.lower() in ("true", "yes", "on", "1")  # type: ignore
+    return type(default)(value)  # type: ignore
+# ~\~ end
 # ~\~ end
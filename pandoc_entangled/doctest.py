@@ -1,19 +1,24 @@
 # ~\~ language=Python filename=pandoc_entangled/doctest.py
 # ~\~ begin <<lit/filters.md|pandoc_entangled/doctest.py>>[init]
 from panflute import (Doc, Element, CodeBlock)
-from ansi2html import Ansi2HTMLConverter
-from .typing import (ActionReturn, JSONType, CodeMap)
-from .tangle import (get_name, expand_code_block)
-from .config import get_language_info
+from .typing import (ActionReturn, JSONType)
+from .tangle import (get_name, get_expander, tangled_hash, CodeMap, Expander, Fragment,
+                     Problem, ValidationError, InvalidDocument, check_references)
+from .config import (Config, get_language_info, get_setting)
+from .timing import (get_timing)
 from collections import defaultdict
 
 import sys
 
 # ~\~ begin <<lit/filters.md|doctest-suite>>[init]
-from dataclasses import dataclass
-from typing import (Optional, List, Dict)
+from dataclasses import (dataclass, field)
+from typing import (Any, Optional, List, Dict, Deque, Callable, Iterable, AsyncIterator, TypeVar,
+                    Set)
+from collections import deque
 from enum import Enum
 
+import threading
+
 class TestStatus(Enum):
     PENDING = 0
     SUCCESS = 1
@@ -30,27 +35,50 @@ class Test:
     result: Optional[str] = None
     error: Optional[str] = None
     status: TestStatus = TestStatus.PENDING
+    elided: int = 0
+    output: "OutputBuffer" = field(default_factory=lambda: OutputBuffer(), repr=False, compare=False)
+    elapsed: float = field(default=0.0, compare=False)
+    messages: int = field(default=0, compare=False)
+    done: threading.Event = field(default_factory=threading.Event, repr=False, compare=False)
 # ~\~ end
 # ~\~ begin <<lit/filters.md|doctest-suite>>[2]
 @dataclass
 class Suite:
     code_blocks: List[Test]
     language: str
+    cached: bool = field(default=False, compare=False)
+    kernel_startup: float = field(default=0.0, compare=False)
+    elapsed: float = field(default=0.0, compare=False)
+
+    def timings(self) -> JSONType:
+        return {
+            "language": self.language,
+            "cached": self.cached,
+            "kernel_startup": self.kernel_startup,
+            "elapsed": self.elapsed,
+            "tests": [{"status": t.status.name, "elapsed": t.elapsed, "messages": t.messages,
+                       "output": len(t.result or ""), "elided": t.elided}
+                      for t in self.code_blocks]}
+
+    def set_done(self) -> None:
+        for t in self.code_blocks:
+            t.done.set()
 # ~\~ end
 # ~\~ begin <<lit/filters.md|get-doc-tests>>[init]
-def get_language(c: CodeBlock) -> str:
-    if not c.classes:
+def get_language(c: Fragment) -> str:
+    if c.language is None:
         raise ValueError(f"Code block `{c.name}` has no language specified.")
-    return c.classes[0]
+    return c.language
 
-def get_doc_tests(code_map: CodeMap) -> Dict[str, Suite]:
-    def convert_code_block(c: CodeBlock) -> Test:
-        name = get_name(c)
-        code = expand_code_block(code_map, c)
+def get_doc_tests(code_map: CodeMap, expander: Optional[Expander] = None) -> Dict[str, Suite]:
+    expander = expander or Expander(code_map)
+
+    def convert_code_block(c: Fragment) -> Test:
+        code = expander.code_block(c)
         if "doctest" in c.classes:
             s = code.split("\n---\n")
             if len(s) != 2:
-                raise ValueError(f"Doc test `{name}` should have single `---` line.")
+                raise ValueError(f"Doc test `{c.name}` should have single `---` line.")
             return Test(s[0], s[1])
         else:
             return Test(code, None)
@@ -64,21 +92,107 @@ def get_doc_tests(code_map: CodeMap) -> Dict[str, Suite]:
 
     return result
 # ~\~ end
+# ~\~ begin <<lit/filters.md|doctest-validate>>[init]
+class KernelUnavailable(ValidationError, RuntimeError):
+    """Raised when no Jupyter kernel can be started for some languages."""
+    pass
+
+
+def is_test(c: Fragment) -> bool:
+    return "doctest" in c.classes or "eval" in c.classes
+
+def check_doc_tests(config: JSONType, code_map: CodeMap,
+                    expander: Optional[Expander] = None) -> List[Problem]:
+    """Finds the problems that keep the suites in `code_map` from being run."""
+    expander = expander or Expander(code_map)
+    names = [k for k, v in code_map.items() if any(is_test(c) for c in v)]
+    languages = (config if isinstance(config, Config) else Config(config)).languages
+    problems = check_references(code_map, names)
+    for name in names:
+        blocks = code_map[name]
+        language = blocks[0].language
+        if language is None:
+            problems.append(Problem(blocks[0].location,
+                                    f"Code block `{name}` has no language specified."))
+        elif language not in languages:
+            problems.append(Problem(blocks[0].location,
+                                    f"Language with identifier `{language}` of code block "
+                                    f"`{name}` not found in config."))
+        for c in blocks:
+            if "doctest" not in c.classes:
+                continue
+            try:
+                code = expander.code_block(c)
+            except ValueError:
+                continue
+            if len(code.split("\n---\n")) != 2:
+                problems.append(Problem(c.location,
+                                        f"Doc test `{name}` should have single `---` line."))
+    return problems
+
+def check_kernel(config: JSONType, language: str) -> Optional[str]:
+    """Returns why no kernel can be started for `language`, or `None`."""
+    info = get_language_info(config, language)
+    kernel_name = info["jupyter"] if "jupyter" in info else None
+    if not kernel_name:
+        return f"No Jupyter kernel known for the {language} language."
+    if kernel_name not in kernel_specs():
+        return f"Jupyter kernel `{kernel_name}` not installed."
+    return None
+
+def check_kernels(config: JSONType, fragments: Iterable[Fragment]) -> List[Problem]:
+    """Checks that there is a kernel for the language of every fragment in
+    `fragments`. Every language is reported once."""
+    problems = []
+    seen: Set[str] = set()
+    for c in fragments:
+        if c.language is None or c.language in seen:
+            continue
+        seen.add(c.language)
+        reason = check_kernel(config, c.language)
+        if reason:
+            problems.append(Problem(c.location, f"Can't run code block `{c.name}`: {reason}"))
+    return problems
+# ~\~ end
 # ~\~ begin <<lit/filters.md|doctest-report>>[init]
+from functools import (lru_cache)
+
+@lru_cache(maxsize=None)
+def ansi_converter() -> Any:
+    from ansi2html import Ansi2HTMLConverter
+    return Ansi2HTMLConverter(inline=True)
+
+memo_limit = 4096
+
+def convert_ansi(text: str) -> str:
+    if "\x1b" not in text:
+        return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    return ansi_converter().convert(text, full=False)
+
+memo_convert_ansi = lru_cache(maxsize=1024)(convert_ansi)
+
+def ansi_to_html(text: str) -> str:
+    """Converts `text`, which may contain ANSI escape sequences, to HTML."""
+    if len(text) > memo_limit:
+        return convert_ansi(text)
+    return memo_convert_ansi(text)
+# ~\~ end
+# ~\~ begin <<lit/filters.md|doctest-report>>[1]
 from panflute import Div, RawBlock
 
 def generate_report(elem: CodeBlock, t: Test) -> ActionReturn:
-    conv = Ansi2HTMLConverter(inline=True)
     def to_raw(txt):
         return Div(
             RawBlock(
                 '<pre class="ansi2html-content">'
-                + conv.convert(txt, full=False)
+                + ansi_to_html(txt)
                 + '</pre>', format="html"),
             classes=["programOutput"])
     # ~\~ begin <<lit/filters.md|doctest-content-div>>[init]
     def content_div(*output):
         status_attr = {"status": t.status.name}
+        if t.elided:
+            status_attr["truncated"] = str(t.elided)
         code = elem.text.split("\n---\n")
         input_code = Div(CodeBlock(
             code[0], identifier=elem.identifier,
@@ -104,123 +218,516 @@ def generate_report(elem: CodeBlock, t: Test) -> ActionReturn:
     return None
 # ~\~ end
 # ~\~ begin <<lit/filters.md|doctest-run-suite>>[init]
-import jupyter_client
+import asyncio
 import queue
+import time
+
+# ~\~ begin <<lit/filters.md|doctest-run-options>>[init]
+N = TypeVar("N", int, float)
+
+@dataclass
+class RunOptions:
+    window: int = 1
+    output_limit: Optional[int] = 2**20
+    suite_output_limit: Optional[int] = 2**24
+    timeout: Optional[float] = 600.0
+    suite_timeout: Optional[float] = None
+    interrupt_grace: float = 5.0
+
+    @staticmethod
+    def from_doc(doc: Doc) -> "RunOptions":
+        def limit(key: str, default: Optional[N]) -> Optional[N]:
+            value = get_setting(doc, "doctest", key, default or 0)
+            return value if value > 0 else None
 
-def run_suite(config: JSONType, s: Suite) -> None:
+        return RunOptions(
+            window=get_setting(doc, "doctest", "pipeline", 1),
+            output_limit=limit("output-limit", RunOptions.output_limit),
+            suite_output_limit=limit("suite-output-limit", RunOptions.suite_output_limit),
+            timeout=limit("timeout", RunOptions.timeout),
+            suite_timeout=limit("suite-timeout", 0.0))
+
+    def output_limit_for(self, used: int) -> Optional[int]:
+        """The output limit for the next test in a suite, given that earlier
+        tests in the suite already kept `used` characters."""
+        if self.suite_output_limit is None:
+            return self.output_limit
+        left = max(0, self.suite_output_limit - used)
+        return left if self.output_limit is None else min(self.output_limit, left)
+# ~\~ end
+# ~\~ begin <<lit/filters.md|jupyter-dispatch>>[init]
+MessageHandler = Callable[[Test, JSONType], bool]
+message_handlers: Dict[str, MessageHandler] = {}
+
+def message_handler(msg_type: str) -> Callable[[MessageHandler], MessageHandler]:
+    """Registers a handler for IOPub messages of type `msg_type`."""
+    def register(f: MessageHandler) -> MessageHandler:
+        message_handlers[msg_type] = f
+        return f
+    return register
+
+def handle(test: Test, msg_id: str, msg: JSONType) -> bool:
+    """Updates `test` using `msg`, if it is a reply to `msg_id`. Returns
+    `True` when the cell is done."""
+    if msg["parent_header"].get("msg_id") != msg_id:
+        return False
+    handler = message_handlers.get(msg["msg_type"])
+    if handler is None or not handler(test, msg["content"]):
+        return False
+    finish_output(test)
+    return True
+
+# ~\~ begin <<lit/filters.md|jupyter-output>>[init]
+class Chunk:
+    __slots__ = ("text", "in_head", "display_id")
+
+    def __init__(self, text: str, in_head: bool, display_id: Optional[str]):
+        self.text = text
+        self.in_head = in_head
+        self.display_id = display_id
+
+
+class OutputBuffer:
+    """Collects the output of a cell. If `limit` is given, only the first and
+    last `limit // 2` characters are kept."""
+    def __init__(self, limit: Optional[int] = None):
+        self.limit = limit
+        self.touched = False
+        self._reset()
+
+    def _reset(self) -> None:
+        self.head: List[Chunk] = []
+        self.tail: Deque[Chunk] = deque()
+        self.head_size = 0
+        self.tail_size = 0
+        self.elided = 0
+        self.displays: Dict[str, Chunk] = {}
+        self.clear_pending = False
+
+    @property
+    def size(self) -> int:
+        return self.head_size + self.tail_size
+
+    def append(self, text: str, display_id: Optional[str] = None) -> None:
+        if self.clear_pending:
+            self.clear()
+        self.touched = True
+        if self.limit is not None:
+            room = self.limit // 2 - self.head_size
+            if room < len(text):
+                if room > 0:
+                    self._push(text[:room], True, None)
+                    text, display_id = text[room:], None
+                self._push(text, False, display_id)
+                self._trim()
+                return
+        self._push(text, True, display_id)
+
+    def update(self, display_id: str, text: str) -> None:
+        chunk = self.displays.get(display_id)
+        if chunk is None:
+            return
+        delta = len(text) - len(chunk.text)
+        chunk.text = text
+        if chunk.in_head:
+            self.head_size += delta
+        else:
+            self.tail_size += delta
+            self._trim()
+
+    def clear(self, wait: bool = False) -> None:
+        if wait:
+            self.clear_pending = True
+            return
+        self._reset()
+        self.touched = True
+
+    def value(self) -> Optional[str]:
+        if not self.touched:
+            return None
+        parts = [c.text for c in self.head]
+        if self.elided:
+            parts.append(f"\n[... {self.elided} characters elided ...]\n")
+        parts.extend(c.text for c in self.tail)
+        return "".join(parts)
+
+    def _push(self, text: str, in_head: bool, display_id: Optional[str]) -> None:
+        chunk = Chunk(text, in_head, display_id)
+        if in_head:
+            self.head.append(chunk)
+            self.head_size += len(text)
+        else:
+            self.tail.append(chunk)
+            self.tail_size += len(text)
+        if display_id is not None:
+            self.displays[display_id] = chunk
+
+    def _trim(self) -> None:
+        assert self.limit is not None
+        room = self.limit - self.limit // 2
+        while self.tail_size > room:
+            chunk = self.tail[0]
+            excess = self.tail_size - room
+            if chunk.display_id is not None and self.displays.get(chunk.display_id) is chunk:
+                del self.displays[chunk.display_id]
+            if len(chunk.text) <= excess:
+                self.tail.popleft()
+                excess = len(chunk.text)
+            else:
+                chunk.text = chunk.text[excess:]
+            self.elided += excess
+            self.tail_size -= excess
+# ~\~ end
+# ~\~ begin <<lit/filters.md|jupyter-output>>[1]
+def finish_output(test: Test) -> None:
+    test.result = test.output.value()
+    test.elided = test.output.elided
+# ~\~ end
+# ~\~ begin <<lit/filters.md|jupyter-handlers>>[init]
+@message_handler("execute_result")
+def execute_result_text(test: Test, content: JSONType) -> bool:
+    data = content["data"].get("text/plain")
+    if data is None:
+        return False
+    test.output.append(str(data))
+    finish_output(test)
+    if (test.expect is None) or (test.result or "").strip() == test.expect.strip():
+        test.status = TestStatus.SUCCESS
+    else:
+        test.status = TestStatus.FAIL
+    return False
+# ~\~ end
+# ~\~ begin <<lit/filters.md|jupyter-handlers>>[1]
+@message_handler("stream")
+def stream_text(test: Test, content: JSONType) -> bool:
+    test.output.append(content["text"])
+    return False
+# ~\~ end
+# ~\~ begin <<lit/filters.md|jupyter-handlers>>[2]
+def display_id(content: JSONType) -> Optional[str]:
+    return (content.get("transient") or {}).get("display_id")
+
+@message_handler("display_data")
+def display_data_text(test: Test, content: JSONType) -> bool:
+    data = content["data"].get("text/plain")
+    if data is not None:
+        test.output.append(data, display_id(content))
+    return False
+
+@message_handler("update_display_data")
+def update_display_data_text(test: Test, content: JSONType) -> bool:
+    data = content["data"].get("text/plain")
+    ident = display_id(content)
+    if data is not None and ident is not None:
+        test.output.update(ident, data)
+    return False
+
+@message_handler("clear_output")
+def clear_output_text(test: Test, content: JSONType) -> bool:
+    test.output.clear(wait=bool(content.get("wait")))
+    return False
+# ~\~ end
+# ~\~ begin <<lit/filters.md|jupyter-handlers>>[3]
+@message_handler("execute_input")
+def execute_input(test: Test, content: JSONType) -> bool:
+    return False
+# ~\~ end
+# ~\~ begin <<lit/filters.md|jupyter-handlers>>[4]
+@message_handler("status")
+def status_idle(test: Test, content: JSONType) -> bool:
+    if content["execution_state"] != "idle":
+        return False
+    if test.expect is None:
+        test.status = TestStatus.SUCCESS
+    elif test.status == TestStatus.PENDING:
+        test.status = TestStatus.FAIL
+    return True
+# ~\~ end
+# ~\~ begin <<lit/filters.md|jupyter-handlers>>[5]
+@message_handler("error")
+def error_traceback(test: Test, content: JSONType) -> bool:
+    test.error = "\n".join(content["traceback"])
+    test.status = TestStatus.ERROR
+    return True
+# ~\~ end
+# ~\~ end
+# ~\~ begin <<lit/filters.md|jupyter-start-kernel>>[init]
+from contextlib import asynccontextmanager
+from . import kernel_pool
+
+# ~\~ begin <<lit/filters.md|jupyter-get-kernel-name-cache>>[init]
+from functools import lru_cache
+
+@lru_cache(maxsize=None)
+def kernel_specs() -> Dict[str, str]:
+    from jupyter_client.kernelspec import find_kernel_specs
+    return find_kernel_specs()
+# ~\~ end
+
+@asynccontextmanager
+async def start_kernel(kernel_name: str) -> AsyncIterator[kernel_pool.Kernel]:
+    async with kernel_pool.connect(kernel_name) as pooled:
+        if pooled is not None:
+            yield pooled
+            return
+
+    from jupyter_client.manager import start_new_async_kernel
+    km, kc = await start_new_async_kernel(kernel_name=kernel_name)
+    try:
+        yield kernel_pool.Kernel(kc, km.interrupt_kernel)
+    finally:
+        kc.stop_channels()
+        await km.shutdown_kernel(now=True)
+# ~\~ end
+
+async def eval_suite(config: JSONType, s: Suite, options: Optional[RunOptions] = None) -> None:
+    options = options or RunOptions()
     # ~\~ begin <<lit/filters.md|jupyter-get-kernel-name>>[init]
     info = get_language_info(config, s.language)
     kernel_name = info["jupyter"] if "jupyter" in info else None
     if not kernel_name:
         raise RuntimeError(f"No Jupyter kernel known for the {s.language} language.")
-    specs = jupyter_client.kernelspec.find_kernel_specs()
-    if kernel_name not in specs:
+    if kernel_name not in kernel_specs():
         raise RuntimeError(f"Jupyter kernel `{kernel_name}` not installed.")
     # ~\~ end
-    with jupyter_client.run_kernel(kernel_name=kernel_name) as kc:
+    suite_start = time.monotonic()
+    async with start_kernel(kernel_name) as kernel:
+        kc = kernel.client
+        s.kernel_startup = time.monotonic() - suite_start
         print(f"Kernel `{kernel_name}` running ...", file=sys.stderr)
         # ~\~ begin <<lit/filters.md|jupyter-eval-test>>[init]
-        def jupyter_eval(test: Test):
-            msg_id = kc.execute(test.code)
-            while True:
-                try:
-                    msg = kc.get_iopub_msg(timeout=1000)
-                    if handle(test, msg_id, msg):
-                       return
+        async def jupyter_eval(tests: List[Test]):
+            in_flight: Dict[str, Test] = {}
+            todo = iter(tests)
+            used = 0
+            started = time.monotonic()
+            suite_deadline = None if options.suite_timeout is None else started + options.suite_timeout
+
+            def submit():
+                while len(in_flight) < max(1, options.window):
+                    test = next(todo, None)
+                    if test is None:
+                        return
+                    in_flight[kc.execute(test.code, stop_on_error=True)] = test
 
+            def start():
+                nonlocal started
+                started = time.monotonic()
+                for test in in_flight.values():
+                    test.output.limit = options.output_limit_for(used)
+                    return
+
+            def deadline() -> Optional[float]:
+                test_deadline = None if options.timeout is None else started + options.timeout
+                return min((d for d in (test_deadline, suite_deadline) if d is not None), default=None)
+
+            submit()
+            start()
+            while in_flight:
+                end = deadline()
+                try:
+                    msg = await kc.get_iopub_msg(
+                        timeout=None if end is None else max(0.0, end - time.monotonic()))
                 except queue.Empty:
-                    test.error = "Operation timed out."
-                    test.status = TestStatus.ERROR
+                    await time_out(*next(iter(in_flight.items())), time.monotonic() - started)
+                    return
+
+                msg_id = msg["parent_header"].get("msg_id")
+                test = in_flight.get(msg_id)
+                if test is None:
+                    continue
+                test.messages += 1
+                if not handle(test, msg_id, msg):
+                    continue
+                test.elapsed = time.monotonic() - started
+                del in_flight[msg_id]
+                used += test.output.size
+                test.done.set()
+                if test.status is TestStatus.ERROR:
                     return
+                submit()
+                start()
         # ~\~ end
         # ~\~ begin <<lit/filters.md|jupyter-eval-test>>[1]
-        def handle(test, msg_id, msg):
-            from pampy import match, _
-            def print_unknown_msg(data):
-                import sys
-                print(data, file=sys.stderr)
-                return False
-            # ~\~ begin <<lit/filters.md|jupyter-handlers>>[init]
-            def execute_result_text(data):
-                test.result = test.result or ""
-                if data is not None:
-                    test.result += str(data)
-                if (test.expect is None) or test.result.strip() == test.expect.strip():
-                    test.status = TestStatus.SUCCESS
-                else:
-                    test.status = TestStatus.FAIL
-                return False
-            # ~\~ end
-            # ~\~ begin <<lit/filters.md|jupyter-handlers>>[1]
-            def stream_text(data):
-                test.result = test.result or ""
-                test.result += data
-                return False
-            # ~\~ end
-            # ~\~ begin <<lit/filters.md|jupyter-handlers>>[2]
-            def status_idle(_):
-                if test.expect is None:
-                    test.status = TestStatus.SUCCESS
-                elif test.status == TestStatus.PENDING:
-                    test.status = TestStatus.FAIL
-                return True
-            # ~\~ end
-            # ~\~ begin <<lit/filters.md|jupyter-handlers>>[3]
-            def error_traceback(tb):
-                test.error = "\n".join(msg["content"]["traceback"])
-                test.status = TestStatus.ERROR 
-                return True
-            # ~\~ end
-            return match(msg
-                # ~\~ begin <<lit/filters.md|jupyter-match>>[init]
-                , { "msg_type": "execute_result"
-                  , "parent_header": { "msg_id" : msg_id }
-                  , "content": { "data" : { "text/plain": _ } } }
-                , execute_result_text
-                # ~\~ end
-                # ~\~ begin <<lit/filters.md|jupyter-match>>[1]
-                , { "msg_type": "stream"
-                  , "parent_header": { "msg_id" : msg_id }
-                  , "content": { "text": _ } }
-                , stream_text
-                # ~\~ end
-                # ~\~ begin <<lit/filters.md|jupyter-match>>[2]
-                , { "msg_type": "display_data"
-                  , "parent_header": { "msg_id" : msg_id }
-                  , "content": { "data": { "text/plain": _ } } }
-                , stream_text
-                # ~\~ end
-                # ~\~ begin <<lit/filters.md|jupyter-match>>[3]
-                , { "msg_type": "status"
-                  , "parent_header": { "msg_id" : msg_id }
-                  , "content": { "execution_state": "idle" } }
-                , status_idle
-                # ~\~ end
-                # ~\~ begin <<lit/filters.md|jupyter-match>>[4]
-                , { "msg_type": "error"
-                  , "parent_header": { "msg_id" : msg_id }
-                  , "content": { "traceback": _ } }
-                , error_traceback
-                # ~\~ end
-                # ~\~ begin <<lit/filters.md|jupyter-match>>[5]
-                , _
-                , lambda x: False
-                # ~\~ end
-                )
+        async def time_out(msg_id: str, test: Test, elapsed: float) -> None:
+            finish_output(test)
+            test.elapsed = elapsed
+            test.error = f"Timed out after {elapsed:.1f} seconds."
+            test.status = TestStatus.ERROR
+            test.done.set()
+            await kernel.interrupt()
+            grace = time.monotonic() + options.interrupt_grace
+            while time.monotonic() < grace:
+                try:
+                    msg = await kc.get_iopub_msg(timeout=max(0.0, grace - time.monotonic()))
+                except queue.Empty:
+                    break
+                if msg["parent_header"].get("msg_id") == msg_id \
+                        and msg["msg_type"] == "status" \
+                        and msg["content"]["execution_state"] == "idle":
+                    return
+            print("Kernel did not respond to interrupt, shutting it down.", file=sys.stderr)
         # ~\~ end
+        await jupyter_eval(s.code_blocks)
+        s.elapsed = time.monotonic() - suite_start
+
+def run_suite(config: JSONType, s: Suite, options: Optional[RunOptions] = None) -> None:
+    asyncio.run(eval_suite(config, s, options))
+# ~\~ end
+# ~\~ begin <<lit/filters.md|doctest-run-suite>>[1]
+import os
+
+def default_jobs() -> int:
+    return min(4, os.cpu_count() or 1)
+
+async def run_suites(config: JSONType, suites: Iterable[Suite], jobs: int,
+                     options: Optional[RunOptions] = None,
+                     on_done: Optional[Callable[[Suite], None]] = None) -> None:
+    """Runs `suites` with at most `jobs` kernels alive at the same time.
+    When a suite is done, it is passed to `on_done`."""
+    limit = asyncio.Semaphore(max(1, jobs))
+
+    async def run(s: Suite) -> None:
+        async with limit:
+            await eval_suite(config, s, options)
+        s.set_done()
+        if on_done is not None:
+            on_done(s)
+
+    await asyncio.gather(*(run(s) for s in suites))
+# ~\~ end
+# ~\~ begin <<lit/filters.md|doctest-run-suite>>[2]
+class Engine:
+    """Runs suites on a background thread."""
+    def __init__(self, config: JSONType, suites: List[Suite], jobs: int,
+                 options: Optional[RunOptions] = None,
+                 on_done: Optional[Callable[[Suite], None]] = None):
+        self.suites = suites
+        self.error: Optional[BaseException] = None
+        self.elapsed = 0.0
+        self.thread = threading.Thread(
+            target=self._run, args=(config, suites, jobs, options, on_done),
+            name="doctest-engine")
 
-        for test in s.code_blocks:
-            jupyter_eval(test)
-            if test.status is TestStatus.ERROR:
-                break
+    def _run(self, *args: Any) -> None:
+        start = time.perf_counter()
+        try:
+            asyncio.run(run_suites(*args))
+        except BaseException as e:
+            self.error = e
+        finally:
+            for s in self.suites:
+                s.set_done()
+            self.elapsed = time.perf_counter() - start
+
+    def start(self) -> "Engine":
+        self.thread.start()
+        return self
+
+    def wait(self, test: Test) -> None:
+        """Waits until `test` is done."""
+        test.done.wait()
+        if self.error is not None:
+            raise self.error
+
+    def join(self) -> None:
+        """Waits until all suites are done."""
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+# ~\~ end
+# ~\~ begin <<lit/filters.md|doctest-cache>>[init]
+from .cache import (Store, cache_path, content_hash)
+
+class ResultCache:
+    """Stores the results of doctest suites by the hash of their content."""
+    def __init__(self, store: Optional[Store], read: bool = True, context: str = ""):
+        self.store = store
+        self.read = read
+        self.context = context
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def from_doc(doc: Doc, options: RunOptions) -> "ResultCache":
+        """The cache for `doc`. Results depend on the tangled files of
+        `doc.code_map`, and on `options`."""
+        mode = os.environ.get("ENTANGLED_DOCTEST_CACHE") \
+            or get_setting(doc, "doctest", "cache", "on")
+        if mode in ("off", "False", "false"):
+            return ResultCache(None)
+        size = get_setting(doc, "doctest", "cache-size", 64 * 2**20)
+        context = content_hash(repr(options), tangled_hash(doc.code_map))
+        store = Store(cache_path("doctest").resolve(), size)
+        return ResultCache(store, read=(mode != "refresh"), context=context)
+
+    def key(self, config: JSONType, s: Suite) -> str:
+        kernel_name = get_language_info(config, s.language).get("jupyter") or ""
+        return content_hash(
+            self.context, kernel_name, s.language,
+            *(part for t in s.code_blocks
+                   for part in (t.code, "" if t.expect is None else "\0" + t.expect)))
+
+    def restore(self, config: JSONType, s: Suite) -> bool:
+        """Restores results of `s` from the cache, returning `True` on success."""
+        if self.store is None:
+            return False
+        data = self.store.get(self.key(config, s)) if self.read else None
+        if data is None or len(data) != len(s.code_blocks):
+            self.misses += 1
+            return False
+        for test, entry in zip(s.code_blocks, data):
+            test.result = entry["result"]
+            test.error = entry["error"]
+            test.status = TestStatus[entry["status"]]
+            test.elided = entry.get("elided", 0)
+        s.cached = True
+        self.hits += 1
+        return True
+
+    def save(self, config: JSONType, s: Suite) -> None:
+        if self.store is None or not all(
+                t.status in (TestStatus.SUCCESS, TestStatus.FAIL) for t in s.code_blocks):
+            return
+        data = [{"result": t.result, "error": t.error, "status": t.status.name,
+                 "elided": t.elided}
+                for t in s.code_blocks]
+        try:
+            self.store.put(self.key(config, s), data)
+        except OSError as e:
+            print(f"Warning: could not write doctest cache: {e}", file=sys.stderr)
+
+    def report(self) -> None:
+        if self.store is not None and (self.hits or self.misses):
+            print(f"Doctest cache: {self.hits} hits, {self.misses} misses.", file=sys.stderr)
 # ~\~ end
 
 def prepare(doc: Doc) -> None:
     assert hasattr(doc, "config"), "Need to read config first."
     assert hasattr(doc, "code_map"), "Need to tangle first."
-    doc.suites = get_doc_tests(doc.code_map)
-    for name, suite in doc.suites.items():
-        run_suite(doc.config, suite)
+    timing = get_timing(doc)
+    with timing.phase("doctest.validate"):
+        problems = check_doc_tests(doc.config, doc.code_map, get_expander(doc))
+    if problems:
+        raise InvalidDocument(problems)
+    doc.suites = get_doc_tests(doc.code_map, get_expander(doc))
+    jobs = get_setting(doc, "doctest", "jobs", default_jobs())
+    options = RunOptions.from_doc(doc)
+    with timing.phase("doctest.cache"):
+        cache = ResultCache.from_doc(doc, options)
+        pending = [suite for suite in doc.suites.values() if not cache.restore(doc.config, suite)]
+    with timing.phase("doctest.validate"):
+        problems = check_kernels(doc.config, (doc.code_map[name][0]
+                                              for name, suite in doc.suites.items()
+                                              if not suite.cached))
+    if problems:
+        raise KernelUnavailable(problems)
+    for suite in doc.suites.values():
+        if suite.cached:
+            suite.set_done()
+    doc.doctest_cache = cache
+    doc.doctest_engine = Engine(doc.config, pending, jobs, options,
+                                on_done=lambda suite: cache.save(doc.config, suite)).start()
     doc.code_counter = defaultdict(lambda: 0)
 
 def action(elem: Element, doc: Doc) -> ActionReturn:
@@ -229,8 +736,18 @@ def action(elem: Element, doc: Doc) -> ActionReturn:
         if "doctest" in elem.classes or "eval" in elem.classes:
             test = doc.suites[name].code_blocks[doc.code_counter[name]]
             doc.code_counter[name] += 1
-            return generate_report(elem, test)
+            with get_timing(doc).phase("doctest.wait"):
+                doc.doctest_engine.wait(test)
+            with get_timing(doc).phase("doctest.report"):
+                return generate_report(elem, test)
 
         doc.code_counter[name] += 1
     return None
+
+def finalize(doc: Doc) -> None:
+    """Waits for all suites to finish, and reports on the result cache."""
+    engine = doc.doctest_engine
+    engine.join()
+    get_timing(doc).phases["doctest.run"] = engine.elapsed
+    doc.doctest_cache.report()
 # ~\~ end
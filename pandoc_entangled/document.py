@@ -0,0 +1,99 @@
+# ~\~ language=Python filename=pandoc_entangled/document.py
+# ~\~ begin <<lit/filters.md|pandoc_entangled/document.py>>[init]
+from panflute import (Doc, Element)
+from panflute.elements import (from_json)
+from typing import (Optional, BinaryIO, Iterable, Callable)
+from contextlib import contextmanager
+
+import gc
+import json
+import sys
+
+from .typing import (Action)
+from .timing import (Timing, get_timing)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+
+@contextmanager
+def gc_paused():
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+def load_document(input_stream: Optional[BinaryIO] = None,
+                  format: Optional[str] = None) -> Doc:
+    """Reads a JSON encoded document from `input_stream` (default: `stdin`)."""
+    data = (input_stream or sys.stdin.buffer).read()
+    with gc_paused():
+        doc = json.loads(data, object_hook=from_json)
+    if not isinstance(doc, Doc):
+        raise ValueError("Input is not a Pandoc document.")
+    doc.format = format or (sys.argv[1] if len(sys.argv) > 1 else "html")
+    return doc
+
+def to_json(elem: Element) -> object:
+    return elem.to_json()
+
+def encode_document(doc: Doc) -> bytes:
+    with gc_paused():
+        if orjson is not None:
+            try:
+                return orjson.dumps(doc, default=to_json)
+            except orjson.JSONEncodeError:
+                pass
+        return json.dumps(doc, default=to_json, check_circular=False,
+                          separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+def dump_document(doc: Doc, output_stream: Optional[BinaryIO] = None) -> None:
+    """Writes `doc` as JSON to `output_stream` (default: `stdout`)."""
+    output_stream = output_stream or sys.stdout.buffer
+    output_stream.write(encode_document(doc))
+    output_stream.flush()
+
+def filter_main(run: Callable[[Doc], Doc], format: Optional[str] = None,
+                prepare: Optional[Callable[[Doc], None]] = None) -> None:
+    """Reads a document from `stdin`, runs `run` on it and writes the result to
+    `stdout`, recording the time spent in every phase. The `prepare` function
+    is run on the document before `run`, outside of any phase."""
+    timing = Timing()
+    with timing.phase("load"):
+        doc = load_document(format=format)
+    doc.timing = timing
+    timing.configure(doc)
+    if prepare is not None:
+        prepare(doc)
+    doc = run(doc)
+    with timing.phase("dump"):
+        dump_document(doc)
+    timing.finish(doc)
+
+def run_filters(actions: Iterable[Action], prepare: Optional[Callable[[Doc], None]] = None,
+                finalize: Optional[Callable[[Doc], None]] = None,
+                doc: Optional[Doc] = None) -> Optional[Doc]:
+    """Same as `panflute.run_filters`, but reads and writes through
+    `load_document` and `dump_document`, and records timings."""
+    def run(doc: Doc) -> Doc:
+        timing = get_timing(doc)
+        if prepare is not None:
+            with timing.phase("prepare"):
+                prepare(doc)
+        with timing.phase("actions"):
+            for action in actions:
+                doc = doc.walk(action, doc)
+        if finalize is not None:
+            with timing.phase("finalize"):
+                finalize(doc)
+        return doc
+
+    if doc is not None:
+        return run(doc)
+    filter_main(run)
+    return None
+# ~\~ end
@@ -3,6 +3,7 @@
 from typing import (Optional)
 from panflute import (Doc, CodeBlock, Div, Link, Str, Plain, RawBlock, Emph)
 from . import tangle
+from .document import (run_filters)
 
 def action(elem, doc):
     if isinstance(elem, CodeBlock) and "inject" in elem.attributes:
@@ -21,20 +22,10 @@ def action(elem, doc):
         targetPane = Div(classes=["tab-pane", "fade", "show", "active"], identifier=name)
         sourcePane = Div(elem, classes=["tab-pane", "fade"], identifier="nav-source")
         content = Div(targetPane, sourcePane, classes=["tab-content"], identifier=f"{name}-content")
-        expanded_source = tangle.get_code(doc.code_map, name)
+        expanded_source = tangle.get_expander(doc).fragment(name)
         script = RawBlock(f"<script>\n{expanded_source}\n</script>")
         return Div(nav, content, script, classes=["entangled-inject"])
 
 def main(doc: Optional[Doc] = None) -> None:
-    import sys
-    import io
-    import panflute
-
-    json_input = sys.stdin.read()
-    json_stream = io.StringIO(json_input)
-    doc = panflute.load(json_stream)
-    tangle.prepare(doc)
-    doc = doc.walk(tangle.action)
-    doc = doc.walk(action)
-    panflute.dump(doc)
+    run_filters([tangle.action, action], prepare=tangle.prepare, doc=doc)
 # ~\~ end
@@ -0,0 +1,176 @@
+# ~\~ language=Python filename=pandoc_entangled/kernel_pool.py
+# ~\~ begin <<lit/filters.md|pandoc_entangled/kernel_pool.py>>[init]
+from contextlib import asynccontextmanager
+from typing import (Optional, Dict, List, AsyncIterator, Awaitable, Callable, TYPE_CHECKING)
+from pathlib import (Path)
+
+import asyncio
+import json
+import os
+import sys
+
+from .cache import (cache_path)
+from .typing import (JSONType)
+
+if TYPE_CHECKING:
+    from jupyter_client import (AsyncKernelManager, AsyncKernelClient)
+
+def socket_path() -> Path:
+    return Path(os.environ.get("ENTANGLED_KERNEL_POOL", cache_path("kernel-pool.sock")))
+
+# ~\~ begin <<lit/filters.md|kernel-handle>>[init]
+class Kernel:
+    """A client to a running kernel, and a way to interrupt the kernel."""
+    def __init__(self, client: "AsyncKernelClient", interrupt: Callable[[], Awaitable[None]]):
+        self.client = client
+        self.interrupt = interrupt
+# ~\~ end
+# ~\~ begin <<lit/filters.md|kernel-pool>>[init]
+class KernelPool:
+    """Keeps `size` warm kernels for every kernel spec that was asked for."""
+    def __init__(self, size: int = 2):
+        self.size = size
+        self.warm: Dict[str, List[asyncio.Task]] = {}
+
+    async def _start(self, kernel_name: str) -> "AsyncKernelManager":
+        from jupyter_client import AsyncKernelManager
+        km = AsyncKernelManager(kernel_name=kernel_name)
+        await km.start_kernel()
+        kc = km.client()
+        kc.start_channels()
+        try:
+            await kc.wait_for_ready(timeout=60)
+        except RuntimeError:
+            await km.shutdown_kernel(now=True)
+            raise
+        finally:
+            kc.stop_channels()
+        return km
+
+    def fill(self, kernel_name: str) -> None:
+        tasks = self.warm.setdefault(kernel_name, [])
+        while len(tasks) < self.size:
+            tasks.append(asyncio.ensure_future(self._start(kernel_name)))
+
+    async def acquire(self, kernel_name: str) -> "AsyncKernelManager":
+        self.fill(kernel_name)
+        task = self.warm[kernel_name].pop(0)
+        self.fill(kernel_name)
+        return await task
+
+    async def release(self, km: "AsyncKernelManager") -> None:
+        await km.shutdown_kernel(now=True)
+
+    async def shutdown(self) -> None:
+        for tasks in self.warm.values():
+            for task in tasks:
+                try:
+                    await self.release(await task)
+                except Exception:
+                    pass
+        self.warm = {}
+# ~\~ end
+# ~\~ begin <<lit/filters.md|kernel-pool-server>>[init]
+async def serve(path: Path, pool: KernelPool, kernels: List[str]) -> None:
+    """Serves kernels from `pool` on Unix socket `path`, until cancelled."""
+    async def reply(writer: asyncio.StreamWriter, msg: JSONType) -> None:
+        writer.write(json.dumps(msg).encode() + b"\n")
+        await writer.drain()
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        km = None
+        try:
+            request = json.loads(await reader.readline())
+            if request.get("cwd") != os.getcwd():
+                await reply(writer, {"error": f"kernel pool runs in `{os.getcwd()}`"})
+                return
+            km = await pool.acquire(request["kernel"])
+            info = km.get_connection_info()
+            info["key"] = info["key"].decode()
+            await reply(writer, {"connection_info": info})
+            async for line in reader:
+                if json.loads(line).get("op") == "interrupt":
+                    await km.interrupt_kernel()
+        except Exception as e:
+            if km is None:
+                await reply(writer, {"error": str(e)})
+        finally:
+            if km is not None:
+                await pool.release(km)
+            writer.close()
+
+    for kernel_name in kernels:
+        pool.fill(kernel_name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.exists():
+        path.unlink()
+    server = await asyncio.start_unix_server(handle, path=str(path))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await pool.shutdown()
+        if path.exists():
+            path.unlink()
+# ~\~ end
+# ~\~ begin <<lit/filters.md|kernel-pool-client>>[init]
+@asynccontextmanager
+async def connect(kernel_name: str) -> AsyncIterator[Optional[Kernel]]:
+    """Borrows a kernel from the kernel pool, if one is running."""
+    path = socket_path()
+    if not path.exists():
+        yield None
+        return
+    try:
+        reader, writer = await asyncio.open_unix_connection(str(path))
+        request = {"kernel": kernel_name, "cwd": os.getcwd()}
+        writer.write(json.dumps(request).encode() + b"\n")
+        response = json.loads(await reader.readline())
+    except (OSError, ValueError):
+        yield None
+        return
+    if "connection_info" not in response:
+        print(f"Not using kernel pool: {response.get('error')}", file=sys.stderr)
+        writer.close()
+        yield None
+        return
+
+    async def interrupt() -> None:
+        writer.write(json.dumps({"op": "interrupt"}).encode() + b"\n")
+        await writer.drain()
+
+    from jupyter_client import AsyncKernelClient
+    kc = AsyncKernelClient()
+    kc.load_connection_info(response["connection_info"])
+    kc.start_channels()
+    try:
+        await kc.wait_for_ready(timeout=60)
+        yield Kernel(kc, interrupt)
+    finally:
+        kc.stop_channels()
+        writer.close()
+# ~\~ end
+# ~\~ begin <<lit/filters.md|kernel-pool-main>>[init]
+def main() -> None:
+    import argparse
+    from .config import read_config
+
+    parser = argparse.ArgumentParser(
+        description="Keep warm Jupyter kernels for pandoc-doctest.")
+    parser.add_argument("kernels", nargs="*", help="kernel specs to keep warm "
+                        "(default: those in the `jupyter` section of the config)")
+    parser.add_argument("--size", type=int, default=2,
+                        help="number of warm kernels per kernel spec")
+    parser.add_argument("--socket", type=Path, default=None,
+                        help=f"path of the socket (default: {socket_path()})")
+    args = parser.parse_args()
+
+    kernels = args.kernels or [k["kernel"] for k in read_config().get("jupyter", [])]
+    path = args.socket or socket_path()
+    print(f"Kernel pool listening on `{path}`.", file=sys.stderr)
+    try:
+        asyncio.run(serve(path, KernelPool(args.size), kernels))
+    except KeyboardInterrupt:
+        pass
+# ~\~ end
+# ~\~ end
@@ -0,0 +1,176 @@
+# ~\~ language=Python filename=pandoc_entangled/main.py
+# ~\~ begin <<lit/filters.md|pandoc_entangled/main.py>>[init]
+from dataclasses import (dataclass, field)
+from typing import (Optional, List, Dict, Callable, Sequence)
+from panflute import (Doc, Element)
+
+import argparse
+import os
+
+from .typing import (Action, ActionReturn)
+from .document import (filter_main)
+from .timing import (get_timing)
+from .config import (read_config)
+from . import (tangle, annotate, doctest, bootstrap, inject)
+
+# ~\~ begin <<lit/filters.md|filter-registry>>[init]
+def read_doc_config(doc: Doc) -> None:
+    if not hasattr(doc, "config"):
+        doc.config = read_config()
+
+def init_card_decks(doc: Doc) -> None:
+    doc.card_deck_sources = []
+
+@dataclass
+class Filter:
+    init: Optional[Callable[[Doc], None]] = None
+    collect: Optional[Action] = None
+    prepare: Optional[Callable[[Doc], None]] = None
+    actions: List[Action] = field(default_factory=list)
+    finalize: Optional[Callable[[Doc], None]] = None
+    shared: bool = False
+
+filters: Dict[str, Filter] = {
+    "tangle": Filter(prepare=tangle.write_files, shared=True),
+    "annotate": Filter(prepare=annotate.prepare, actions=[annotate.action]),
+    "doctest": Filter(init=read_doc_config, prepare=doctest.prepare, actions=[doctest.action],
+                      finalize=doctest.finalize, shared=True),
+    "bootstrap": Filter(init=init_card_decks, collect=bootstrap.collect_card_deck,
+                        prepare=bootstrap.prepare,
+                        actions=[bootstrap.bootstrap_card_deck, bootstrap.bootstrap_fold_code]),
+    "inject": Filter(actions=[inject.action]),
+}
+# ~\~ end
+# ~\~ begin <<lit/filters.md|fused-walk>>[init]
+class FusedWalk:
+    """Applies a list of actions to a document in a single walk."""
+    def __init__(self, actions: Sequence[Action]):
+        self.actions = list(actions)
+        self.done: Dict[int, Element] = {}
+
+    def is_done(self, elem: Element) -> bool:
+        return id(elem) in self.done
+
+    def walk(self, elem: Element, doc: Doc, actions: List[Action]) -> ActionReturn:
+        def action(e: Element, doc: Doc) -> ActionReturn:
+            if self.is_done(e):
+                return None
+            result = self.apply(e, doc, actions)
+            for r in (result if isinstance(result, list) else [e if result is None else result]):
+                self.done[id(r)] = r
+            return result
+
+        return elem.walk(action, doc, stop_if=self.is_done)
+
+    def apply(self, elem: Element, doc: Doc, actions: List[Action]) -> ActionReturn:
+        for i, action in enumerate(actions):
+            result = action(elem, doc)
+            if result is None:
+                continue
+            rest = actions[i+1:]
+            if not rest:
+                return result
+            if not isinstance(result, list):
+                return self.walk(result, doc, rest)
+            walked: List[Element] = []
+            for r in result:
+                w = self.walk(r, doc, rest)
+                walked.extend(w if isinstance(w, list) else [w])
+            return walked
+        return None
+
+    def run(self, doc: Doc) -> Doc:
+        self.walk(doc, doc, self.actions)
+        return doc
+# ~\~ end
+# ~\~ begin <<lit/filters.md|run-filters>>[init]
+default_filters = ["bootstrap", "doctest"]
+
+def select_filters(doc: Doc, names: Optional[str] = None,
+                   default: List[str] = default_filters) -> List[str]:
+    """Gets the names of the filters to run, from the command line, the
+    environment or the document metadata."""
+    selected = names or os.environ.get("ENTANGLED_FILTERS") \
+        or doc.get_metadata("entangled.filters", None) or default
+    if isinstance(selected, str):
+        selected = [name.strip() for name in selected.split(",") if name.strip()]
+    for name in selected:
+        if name not in filters:
+            raise ValueError(f"Unknown filter `{name}`, choose from: {', '.join(filters)}.")
+    return list(selected)
+
+def run(doc: Doc, names: List[str]) -> Doc:
+    """Runs the filters in `names` on `doc`."""
+    return run_project([doc], names)[0]
+# ~\~ end
+# ~\~ begin <<lit/filters.md|run-filters>>[1]
+shared_state = ["config", "code_map", "expander", "suites", "code_counter",
+                "doctest_engine", "doctest_cache", "timing"]
+
+def share(project: Doc, doc: Doc) -> None:
+    for attr in shared_state:
+        if hasattr(project, attr):
+            setattr(doc, attr, getattr(project, attr))
+
+def run_project(docs: List[Doc], names: List[str]) -> List[Doc]:
+    """Runs the filters in `names` on `docs`, sharing one code map."""
+    project = docs[0]
+    timing = get_timing(project)
+    selected = [(name, filters[name]) for name in names]
+
+    def stage(f: Filter, step: Optional[Callable[[Doc], None]]) -> None:
+        if step is None:
+            return
+        for doc in ([project] if f.shared else docs):
+            share(project, doc)
+            step(doc)
+
+    with timing.phase("collect"):
+        tangle.prepare(project)
+        for _, f in selected:
+            stage(f, f.init)
+
+        collectors = [tangle.action] + [f.collect for _, f in selected if f.collect]
+
+        def collect(elem: Element, doc: Doc) -> None:
+            for c in collectors:
+                c(elem, doc)
+
+        for doc in docs:
+            share(project, doc)
+            doc.walk(collect)
+
+    for name, f in selected:
+        if f.prepare:
+            with timing.phase(f"prepare.{name}"):
+                stage(f, f.prepare)
+    actions = [a for _, f in selected for a in f.actions]
+    if actions:
+        with timing.phase("actions"):
+            for doc in docs:
+                share(project, doc)
+                FusedWalk(actions).run(doc)
+    for name, f in selected:
+        if f.finalize:
+            with timing.phase(f"finalize.{name}"):
+                stage(f, f.finalize)
+    return docs
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Run several Entangled filters in a single pass.")
+    parser.add_argument("--filters", help="comma separated list of filters: "
+                        + ", ".join(filters))
+    parser.add_argument("format", nargs="?", help="output format (passed by Pandoc)")
+    args = parser.parse_args()
+    names: List[str] = []
+
+    def select(doc: Doc) -> None:
+        try:
+            names.extend(select_filters(doc, args.filters))
+        except ValueError as e:
+            parser.error(str(e))
+
+    filter_main(lambda doc: run(doc, names), format=args.format, prepare=select)
+# ~\~ end
+# ~\~ end
@@ -0,0 +1,204 @@
+# ~\~ language=Python filename=pandoc_entangled/markdown.py
+# ~\~ begin <<lit/filters.md|pandoc_entangled/markdown.py>>[init]
+from typing import (Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple)
+from pathlib import (Path)
+
+import argparse
+import re
+
+from .timing import (Timing)
+from . import tangle
+
+# ~\~ begin <<lit/filters.md|markdown-attributes>>[init]
+Attributes = Tuple[str, List[str], Dict[str, str]]
+
+attribute_pattern = re.compile(r"""
+      \#(?P<identifier>[\w\-:.]+)
+    | \.(?P<class>[^\W\d_][\w\-:.]*)
+    | (?P<key>[^\W\d_][\w\-:.]*)=
+      (?: "(?P<dquoted>(?:[^"\\]|\\.)*)" | '(?P<squoted>(?:[^'\\]|\\.)*)' | (?P<value>[^\s}]*) )
+    | (?P<unnumbered>-)
+    """, re.VERBOSE)
+
+def unescape(text: str) -> str:
+    return re.sub(r"\\(.)", r"\1", text)
+
+def parse_attributes(text: str) -> Optional[Attributes]:
+    """Parses the attributes between braces in `text`, as Pandoc would.
+    Returns `None` if `text` is not a valid attribute list."""
+    if not (text.startswith("{") and text.endswith("}")):
+        return None
+    body = text[1:-1]
+    identifier = ""
+    classes: List[str] = []
+    attributes: Dict[str, str] = {}
+    pos = 0
+    while True:
+        while pos < len(body) and body[pos].isspace():
+            pos += 1
+        if pos == len(body):
+            return identifier, classes, attributes
+        m = attribute_pattern.match(body, pos)
+        if m is None or (m.end() < len(body) and not body[m.end()].isspace()):
+            return None
+        pos = m.end()
+        if m["identifier"] is not None:
+            identifier = m["identifier"]
+        elif m["class"] is not None:
+            classes.append(m["class"])
+        elif m["key"] is not None:
+            quoted = m["dquoted"] if m["dquoted"] is not None else m["squoted"]
+            value = unescape(quoted) if quoted is not None else m["value"]
+            if m["key"] == "id":
+                identifier = value
+            elif m["key"] == "class":
+                classes.extend(value.split())
+            else:
+                attributes[m["key"]] = value
+        else:
+            classes.append("unnumbered")
+# ~\~ end
+# ~\~ begin <<lit/filters.md|markdown-scanner>>[init]
+fence_pattern = re.compile(r"(?P<indent> {0,3})(?P<fence>`{3,}|~{3,})[ \t]*(?P<info>.*?)[ \t]*")
+container_pattern = re.compile(r"(?: *(?:>|(?:[-+*]|\d{1,9}[.)])(?= )))* *")
+list_item_pattern = re.compile(r" {0,3}(?:[-+*]|\d{1,9}[.)])(?: |$)")
+
+NumberedLine = Tuple[int, str]
+
+class Block(NamedTuple):
+    """A fenced code block, with the line number of its opening fence."""
+    line: int
+    identifier: str
+    classes: List[str]
+    attributes: Dict[str, str]
+    text: str
+
+class NestedBlocks:
+    """Finds the named code blocks that are inside block quotes or list items,
+    which the scanner does not read. Lines that are indented by four spaces
+    or more are only counted when they follow a list item."""
+    def __init__(self) -> None:
+        self.blocks: List[Block] = []
+        self.in_list = False
+        self.blank = True
+
+    def scan(self, n: int, line: str) -> None:
+        if not line.strip():
+            self.blank = True
+            return
+        if list_item_pattern.match(line):
+            self.in_list = True
+        elif self.blank and not line.startswith("    "):
+            self.in_list = False
+        self.blank = False
+        if "{" not in line:
+            return
+        container = container_pattern.match(line)
+        start = container.end() if container else 0
+        if line[:start].isspace() and not self.in_list:
+            return
+        m = fence_pattern.fullmatch(line, start)
+        if m is None or not m["info"].startswith("{"):
+            return
+        attributes = parse_attributes(m["info"])
+        if attributes is not None and (attributes[0] or "file" in attributes[2]):
+            self.blocks.append(Block(n, *attributes, ""))
+
+def code_blocks(lines: Iterable[str], front_matter: bool = True,
+                nested: Optional[NestedBlocks] = None) -> Iterator[Block]:
+    """Yields the fenced code blocks in the Markdown text given by `lines`.
+    Lines that are not part of a code block are passed on to `nested`."""
+    return numbered_code_blocks(enumerate(lines, 1), front_matter, nested)
+
+def info_attributes(info: str) -> Optional[Attributes]:
+    """Gets the attributes from the `info` of an opening fence. Returns `None`
+    if Pandoc would not see a code block."""
+    if info.startswith("{"):
+        return parse_attributes(info)
+    return "", [], {}
+
+def numbered_code_blocks(lines: Iterable[NumberedLine], front_matter: bool = True,
+                         nested: Optional[NestedBlocks] = None) -> Iterator[Block]:
+    """Yields the fenced code blocks in the numbered lines `lines`."""
+    it = ((n, line.rstrip("\n").expandtabs(4)) for n, line in lines)
+    first = front_matter
+    for n, line in it:
+        if first and line.strip() == "---":
+            for _, line in it:
+                if line.rstrip() in ("---", "..."):
+                    break
+            first = False
+            continue
+        first = False
+        if line.lstrip(" ").startswith("<!--"):
+            while "-->" not in line:
+                _, line = next(it, (n, "-->"))
+            continue
+        m = fence_pattern.fullmatch(line)
+        if m is None:
+            if nested is not None:
+                nested.scan(n, line)
+            continue
+        if m["fence"][0] == "`" and "`" in m["info"]:
+            continue
+        yield from fenced_block(m, n, it, nested)
+
+def fenced_block(m: "re.Match[str]", n: int, it: Iterator[NumberedLine],
+                 nested: Optional[NestedBlocks] = None) -> Iterator[Block]:
+    indent = len(m["indent"])
+    fence = m["fence"]
+    closing = re.compile(" {0,3}" + re.escape(fence[0]) + "{" + str(len(fence)) + r",}[ \t]*")
+    body: List[NumberedLine] = []
+    for numbered in it:
+        if closing.fullmatch(numbered[1]):
+            break
+        body.append(numbered)
+    else:
+        yield from numbered_code_blocks(body, front_matter=False, nested=nested)
+        return
+    attributes = info_attributes(m["info"])
+    if attributes is None:
+        return
+    identifier, classes, attrs = attributes
+    text = "\n".join(line[min(indent, len(line) - len(line.lstrip(" "))):] for _, line in body)
+    yield Block(n, identifier, classes, attrs, text)
+# ~\~ end
+# ~\~ begin <<lit/filters.md|markdown-main>>[init]
+def read_code_map(paths: Iterable[Path]) -> tangle.CodeMap:
+    """Reads the code blocks of all Markdown files in `paths`, in order."""
+    code_map = tangle.CodeMap()
+    problems: List[tangle.Problem] = []
+    for path in paths:
+        nested = NestedBlocks()
+        with open(path, "r", encoding="utf-8-sig") as f:
+            for block in code_blocks(f, nested=nested):
+                name = block.identifier or block.attributes.get("file")
+                if name:
+                    code_map.add(tangle.Fragment(name, block.text, block.classes,
+                                                 block.attributes.get("file"),
+                                                 str(path), block.line))
+        problems.extend(
+            tangle.Problem(f"{path}:{block.line}",
+                           f"Code block `{block.identifier or block.attributes['file']}` "
+                           "is inside a block quote or list item, which `pandoc-tangle-md` "
+                           "can't read; use `pandoc-tangle` for this document.")
+            for block in nested.blocks)
+    if problems:
+        raise tangle.InvalidDocument(problems)
+    return code_map
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Tangle Markdown files, without running Pandoc.")
+    parser.add_argument("inputs", nargs="+", type=Path, help="Markdown files, in order")
+    args = parser.parse_args()
+    timing = Timing()
+    try:
+        with timing.phase("load"):
+            code_map = read_code_map(args.inputs)
+        tangle.tangle_files(code_map, tangle.Expander(code_map), timing)
+    except tangle.InvalidDocument as e:
+        parser.exit(1, f"{e}\n")
+    timing.finish()
+# ~\~ end
+# ~\~ end
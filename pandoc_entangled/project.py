@@ -0,0 +1,102 @@
+# ~\~ language=Python filename=pandoc_entangled/project.py
+# ~\~ begin <<lit/filters.md|pandoc_entangled/project.py>>[init]
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor)
+from itertools import (repeat)
+from pathlib import (Path)
+from typing import (List, Optional, Tuple)
+from panflute import (Doc)
+
+import argparse
+import io
+import os
+import subprocess
+import sys
+
+from .document import (load_document, encode_document)
+from .main import (run_project, select_filters)
+from .timing import (Timing)
+
+default_filters = ["tangle", "doctest"]
+
+extensions = {"html": "html", "html4": "html", "html5": "html", "markdown": "md",
+              "gfm": "md", "commonmark": "md", "latex": "tex", "plain": "txt"}
+
+def read_ast(path: str, input_format: str = "markdown") -> bytes:
+    """Reads a document as Pandoc JSON."""
+    if path.endswith(".json"):
+        return Path(path).read_bytes()
+    return subprocess.run(["pandoc", "-f", input_format, "-t", "json", path],
+                          capture_output=True, check=True).stdout
+
+def load_documents(paths: List[str], input_format: str = "markdown",
+                   output_format: str = "html5", jobs: int = 1) -> List[Doc]:
+    """Reads the documents in `paths`, that are to be written in `output_format`."""
+    with ProcessPoolExecutor(max_workers=max(1, jobs)) as pool:
+        asts = list(pool.map(read_ast, paths, repeat(input_format)))
+    docs = [load_document(io.BytesIO(ast), format=output_format) for ast in asts]
+    for doc, path in zip(docs, paths):
+        doc.source = path
+    return docs
+
+def output_path(path: str, output_dir: Path, output_format: str) -> Path:
+    return output_dir / (Path(path).stem + "." + extensions.get(output_format, output_format))
+
+def write_output(doc: Doc, path: Path, output_format: str, pandoc_args: List[str]) -> None:
+    data = encode_document(doc)
+    if output_format == "json":
+        path.write_bytes(data)
+        return
+    subprocess.run(["pandoc", "-f", "json", "-t", output_format, "-o", str(path)] + pandoc_args,
+                   input=data, check=True)
+
+def parse_arguments(parser: argparse.ArgumentParser, argv: List[str]) \
+        -> Tuple[argparse.Namespace, List[str]]:
+    """Parses `argv`; the arguments after `--` are returned separately, to be
+    passed on to Pandoc."""
+    if "--" in argv:
+        i = argv.index("--")
+        return parser.parse_args(argv[:i]), argv[i+1:]
+    return parser.parse_args(argv), []
+
+def argument_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Run Entangled filters on all documents of a project at once.",
+        usage="%(prog)s [options] inputs... [-- pandoc options...]",
+        epilog="Arguments after `--` are passed on to Pandoc when writing the output.")
+    parser.add_argument("inputs", nargs="+", help="input documents, in order")
+    parser.add_argument("--filters", help="comma separated list of filters (default: "
+                        + ",".join(default_filters) + ")")
+    parser.add_argument("-f", "--from", dest="input_format", default="markdown",
+                        help="input format (default: markdown)")
+    parser.add_argument("-t", "--to", dest="output_format", default="html5",
+                        help="output format (default: html5)")
+    parser.add_argument("-o", "--output-dir", type=Path, help="directory to write output to")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="number of documents to read or write at the same time")
+    return parser
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argument_parser()
+    args, pandoc_args = parse_arguments(parser, sys.argv[1:] if argv is None else argv)
+
+    timing = Timing()
+    with timing.phase("load"):
+        docs = load_documents(args.inputs, args.input_format, args.output_format, args.jobs)
+    project = docs[0]
+    project.timing = timing
+    timing.configure(project)
+    try:
+        names = select_filters(project, args.filters, default=default_filters)
+    except ValueError as e:
+        parser.error(str(e))
+    run_project(docs, names)
+
+    if args.output_dir is not None:
+        args.output_dir.mkdir(parents=True, exist_ok=True)
+        paths = [output_path(p, args.output_dir, args.output_format) for p in args.inputs]
+        with timing.phase("dump"):
+            with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+                list(pool.map(write_output, docs, paths, repeat(args.output_format),
+                              repeat(pandoc_args)))
+    timing.finish(project)
+# ~\~ end
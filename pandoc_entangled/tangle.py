@@ -1,75 +1,191 @@
 # ~\~ language=Python filename=pandoc_entangled/tangle.py
 # ~\~ begin <<lit/filters.md|pandoc_entangled/tangle.py>>[init]
-from panflute import (run_filter, Doc, Element, CodeBlock)
-from typing import (Optional, Dict, Callable)
-from .typing import (CodeMap)
+from typing import (Optional, Dict, List, Set, FrozenSet, Iterator, Iterable, NamedTuple,
+                    Tuple, BinaryIO, TYPE_CHECKING)
+from .typing import (JSONType)
+from .timing import (Timing, get_timing)
 import sys
 
+if TYPE_CHECKING:
+    from panflute import (Doc, Element, CodeBlock)
+
+# ~\~ begin <<lit/filters.md|fragment>>[init]
+class Fragment:
+    """A named code block, without the document around it."""
+    __slots__ = ("name", "language", "classes", "file", "text", "source", "line")
+
+    def __init__(self, name: str, text: str, classes: Iterable[str] = (),
+                 file: Optional[str] = None, source: Optional[str] = None,
+                 line: Optional[int] = None):
+        self.name = name
+        self.text = text
+        self.classes = list(classes)
+        self.language = self.classes[0] if self.classes else None
+        self.file = file
+        self.source = source
+        self.line = line
+
+    @staticmethod
+    def from_code_block(elem: "CodeBlock", name: str, source: Optional[str] = None,
+                        line: Optional[int] = None) -> "Fragment":
+        return Fragment(name, elem.text, elem.classes, elem.attributes.get("file"),
+                        source, line)
+
+    @property
+    def location(self) -> str:
+        """The source file and line of the fragment, as far as these are known."""
+        return self.line_location(-1)
+
+    def line_location(self, i: int) -> str:
+        """The location of line `i` of the text, counting from zero."""
+        if self.line is None:
+            return f"{self.source} «{self.name}»" if self.source else f"«{self.name}»"
+        return f"{self.source or '<document>'}:{self.line + 1 + i}"
+
+    def references(self) -> Iterator[Tuple[int, str]]:
+        """Yields the line number in the text, and the name, of every reference."""
+        for i, line in enumerate(self.text.splitlines()):
+            if "<<" in line:
+                match = reference_pattern.fullmatch(line)
+                if match:
+                    yield i, match["name"]
+
+    def __repr__(self) -> str:
+        return f"Fragment({self.name!r}, {self.location})"
+
+
+class CodeMap(Dict[str, List[Fragment]]):
+    """Fragments by name, in the order in which they were found, with an index
+    of the files they are tangled to."""
+    def __init__(self) -> None:
+        super().__init__()
+        self.files: Dict[str, str] = {}
+
+    def add(self, fragment: Fragment) -> None:
+        blocks = self.setdefault(fragment.name, [])
+        if not blocks and fragment.file is not None:
+            self.files[fragment.file] = fragment.name
+        blocks.append(fragment)
+# ~\~ end
 # ~\~ begin <<lit/filters.md|get-code-block>>[init]
 import re
+from textwrap import indent
 
-# ~\~ begin <<lit/filters.md|replace-expr>>[init]
-def replace_expr(expr: str, replace: Callable[..., str], text: str) -> str:
-    """Matches (fullmatch) `text` using the expression `expr`. If the expression
-    matches, then returns the result of passing named sub-matches as
-    keyword arguments to `replace`. Returns `text` otherwise."""
-    match = re.fullmatch(expr, text)
-    if match:
-        return replace(**match.groupdict())
-    else:
-        return text
+# ~\~ begin <<lit/filters.md|reference-pattern>>[init]
+reference_pattern = re.compile("(?P<prefix>[ \t]*)<<(?P<name>[^ >]*)>>\\Z")
 # ~\~ end
+# ~\~ begin <<lit/filters.md|expander>>[init]
+class CyclicReference(ValueError):
+    """Raised when a fragment (indirectly) references itself."""
+    pass
 
-def get_code(code_map: CodeMap, name: str) -> str:
-    # ~\~ begin <<lit/filters.md|expand>>[init]
-    def expand(code: CodeBlock) -> str:
-        pattern = "(?P<prefix>[ \t]*)<<(?P<name>[^ >]*)>>\\Z"
-        return "\n".join(
-            replace_expr(pattern, look_up, line)
-            for line in code.text.splitlines())
-    # ~\~ end
-    # ~\~ begin <<lit/filters.md|look-up>>[init]
-    from textwrap import indent
-
-    def look_up(*, name: str, prefix: str) -> str:
-        blocks = code_map[name]
-        if not blocks:
-            raise ValueError(f"No code with name `{name}` found.")
-        result = "\n".join(expand(code) for code in blocks)
-        return indent(result, prefix)
-    # ~\~ end
-    return look_up(name=name, prefix="")
-
-def expand_code_block(code_map: CodeMap, code_block: CodeBlock) -> str:
-    # ~\~ begin <<lit/filters.md|expand>>[init]
-    def expand(code: CodeBlock) -> str:
-        pattern = "(?P<prefix>[ \t]*)<<(?P<name>[^ >]*)>>\\Z"
-        return "\n".join(
-            replace_expr(pattern, look_up, line)
-            for line in code.text.splitlines())
-    # ~\~ end
-    # ~\~ begin <<lit/filters.md|look-up>>[init]
-    from textwrap import indent
-
-    def look_up(*, name: str, prefix: str) -> str:
-        blocks = code_map[name]
+
+class Expander:
+    """Expands references in code blocks found in `code_map`, memoizing the
+    expanded text of each named fragment."""
+    def __init__(self, code_map: CodeMap):
+        self.code_map = code_map
+        self._cache: Dict[str, str] = {}
+        self._stack: List[str] = []
+
+    def _blocks(self, name: str) -> List[Fragment]:
+        if name in self._stack:
+            cycle = self._stack[self._stack.index(name):] + [name]
+            raise CyclicReference(
+                f"Cyclic reference: {' -> '.join(f'`{n}`' for n in cycle)}.")
+        blocks = self.code_map.get(name)
         if not blocks:
             raise ValueError(f"No code with name `{name}` found.")
-        result = "\n".join(expand(code) for code in blocks)
-        return indent(result, prefix)
-    # ~\~ end
-    return expand(code_block)
+        return blocks
+
+    def fragment(self, name: str) -> str:
+        """Returns the expanded text of all code blocks named `name`."""
+        if name in self._cache:
+            return self._cache[name]
+        blocks = self._blocks(name)
+
+        self._stack.append(name)
+        try:
+            result = "\n".join(self.code_block(code) for code in blocks)
+        finally:
+            self._stack.pop()
+        self._cache[name] = result
+        return result
+
+    def fork(self) -> "Expander":
+        """Returns an expander for the same code map, that shares the
+        fragments expanded so far, for use on another thread."""
+        other = Expander(self.code_map)
+        other._cache = self._cache
+        return other
+
+    def code_block(self, code: Fragment) -> str:
+        """Returns the text of `code` with all references expanded."""
+        return "\n".join(self._expand_line(line) for line in code.text.splitlines())
+
+    def _expand_line(self, line: str) -> str:
+        if "<<" not in line:
+            return line
+        match = reference_pattern.fullmatch(line)
+        if match is None:
+            return line
+        return indent(self.fragment(match["name"]), match["prefix"])
 # ~\~ end
+# ~\~ begin <<lit/filters.md|expander>>[1]
+    def lines(self, name: str, prefix: str = "") -> Iterator[str]:
+        """Yields the lines of the expanded text of all code blocks named
+        `name`, indented with `prefix`."""
+        if name in self._cache:
+            for line in self._cache[name].split("\n"):
+                yield prefix + line if line.strip() else line
+            return
+        blocks = self._blocks(name)
 
-# ~\~ begin <<lit/filters.md|tangle-prepare>>[init]
-from collections import defaultdict
+        self._stack.append(name)
+        try:
+            for code in blocks:
+                yield from self._code_block_lines(code, prefix)
+        finally:
+            self._stack.pop()
+
+    def _code_block_lines(self, code: Fragment, prefix: str) -> Iterator[str]:
+        lines = code.text.splitlines()
+        if not lines:
+            yield ""
+        for line in lines:
+            match = reference_pattern.fullmatch(line) if "<<" in line else None
+            if match is not None:
+                yield from self.lines(match["name"], prefix + match["prefix"])
+            elif line.strip():
+                yield prefix + line
+            else:
+                yield line
+# ~\~ end
+
+def get_code(code_map: CodeMap, name: str) -> str:
+    return Expander(code_map).fragment(name)
+
+def expand_code_block(code_map: CodeMap, code_block: Fragment) -> str:
+    return Expander(code_map).code_block(code_block)
+# ~\~ end
+# ~\~ begin <<lit/filters.md|get-code-block>>[1]
+def get_expander(doc: "Doc") -> Expander:
+    """Returns the `Expander` for `doc.code_map`, creating it on first use.
+    The expander is replaced whenever `doc.code_map` is."""
+    expander = getattr(doc, "expander", None)
+    if expander is None or expander.code_map is not doc.code_map:
+        expander = Expander(doc.code_map)
+        doc.expander = expander
+    return expander
+# ~\~ end
 
-def prepare(doc: Doc) -> None:
-    doc.code_map = defaultdict(list)
+# ~\~ begin <<lit/filters.md|tangle-prepare>>[init]
+def prepare(doc: "Doc") -> None:
+    doc.code_map = CodeMap()
 # ~\~ end
 # ~\~ begin <<lit/filters.md|tangle-action>>[init]
 # ~\~ begin <<lit/filters.md|get-name>>[init]
-def get_name(elem: Element) -> Optional[str]:
+def get_name(elem: "Element") -> Optional[str]:
     if elem.identifier:
         return elem.identifier
 
@@ -79,42 +195,270 @@ def get_name(elem: Element) -> Optional[str]:
     return None
 # ~\~ end
 
-def action(elem: Element, doc: Doc) -> None:
-    if isinstance(elem, CodeBlock):
+def action(elem: "Element", doc: "Doc") -> None:
+    if elem.tag == "CodeBlock":
         name = get_name(elem)
         if name:
-            doc.code_map[name].append(elem)
+            doc.code_map.add(Fragment.from_code_block(elem, name, getattr(doc, "source", None)))
+# ~\~ end
+# ~\~ begin <<lit/filters.md|tangle-validate>>[init]
+class Problem(NamedTuple):
+    """Something that is wrong with a fragment, or with the configuration."""
+    location: str
+    message: str
+
+    def __str__(self) -> str:
+        return f"{self.location}: {self.message}"
+
+
+class ValidationError(Exception):
+    """Raised when validation finds problems, listing all of them."""
+    def __init__(self, problems: List[Problem]):
+        self.problems = problems
+        super().__init__("\n".join([f"Found {len(problems)} problem(s):"]
+                                   + [f"    {p}" for p in problems]))
+
+
+class InvalidDocument(ValidationError, ValueError):
+    """Raised when the code in a document has problems."""
+    pass
+
+
+def check_references(code_map: CodeMap, roots: Optional[Iterable[str]] = None) -> List[Problem]:
+    """Finds missing and cyclic references in the fragments that `roots`
+    depend on, or in all fragments."""
+    problems: List[Problem] = []
+    done: Set[str] = set()
+    stack: List[str] = []
+    cycles: Set[FrozenSet[str]] = set()
+
+    def visit(name: str) -> None:
+        stack.append(name)
+        for code in code_map[name]:
+            for i, ref in code.references():
+                if ref in stack:
+                    cycle = stack[stack.index(ref):] + [ref]
+                    if frozenset(cycle) not in cycles:
+                        cycles.add(frozenset(cycle))
+                        problems.append(Problem(code.line_location(i), "Cyclic reference: "
+                                                + " -> ".join(f"`{n}`" for n in cycle) + "."))
+                elif ref not in code_map:
+                    problems.append(Problem(code.line_location(i),
+                                            f"No code with name `{ref}` found, in `{name}`."))
+                elif ref not in done:
+                    visit(ref)
+        stack.pop()
+        done.add(name)
+
+    for name in (code_map if roots is None else roots):
+        if name not in done:
+            visit(name)
+    return problems
+# ~\~ end
+# ~\~ begin <<lit/filters.md|tangle-index>>[init]
+from .cache import (cache_path, content_hash, read_json, write_json)
+from pathlib import (Path)
+import os
+
+class ReferenceGraph:
+    """Content hashes and direct references of every fragment in a code map."""
+    def __init__(self, code_map: CodeMap):
+        self.hashes: Dict[str, str] = {}
+        self.references: Dict[str, Set[str]] = {}
+        for name, blocks in code_map.items():
+            self.hashes[name] = content_hash(*(code.text for code in blocks))
+            self.references[name] = {
+                ref for code in blocks for _, ref in code.references() }
+
+    def dependencies(self, name: str) -> Dict[str, str]:
+        """Returns the hashes of all fragments that `name` depends on,
+        including itself. Missing fragments get an empty hash."""
+        result: Dict[str, str] = {}
+        todo = [name]
+        while todo:
+            n = todo.pop()
+            if n in result:
+                continue
+            result[n] = self.hashes.get(n, "")
+            todo.extend(self.references.get(n, ()))
+        return result
+
+def tangled_hash(code_map: CodeMap) -> str:
+    """Returns a hash of the names of all tangled files, and of the fragments
+    that they are made of."""
+    graph = ReferenceGraph(code_map)
+    fragments: Dict[str, str] = {}
+    for name in code_map.files.values():
+        fragments.update(graph.dependencies(name))
+    return content_hash(*(f"{f}\0{n}" for f, n in sorted(code_map.files.items())),
+                        *(f"{n}\0{h}" for n, h in sorted(fragments.items())))
+# ~\~ end
+# ~\~ begin <<lit/filters.md|tangle-index>>[1]
+class TangleIndex:
+    """Persistent record of the fragments that every tangled file was
+    generated from."""
+    def __init__(self, path: Path, files: Dict[str, JSONType]):
+        self.path = path
+        self.files = files
+        self.changed = False
+
+    @staticmethod
+    def load(path: Optional[Path] = None) -> "TangleIndex":
+        path = path or cache_path("tangle-index.json")
+        data = read_json(path)
+        if not isinstance(data, dict) or data.get("version") != 2:
+            return TangleIndex(path, {})
+        return TangleIndex(path, data["files"])
+
+    @staticmethod
+    def _stat(filename: str) -> Optional[List[int]]:
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return [st.st_size, st.st_mtime_ns]
+
+    def is_current(self, filename: str, fragments: Dict[str, str]) -> bool:
+        entry = self.files.get(filename)
+        return entry is not None \
+            and entry["fragments"] == fragments \
+            and entry["stat"] == self._stat(filename)
+
+    def update(self, filename: str, fragments: Dict[str, str]) -> None:
+        self.files[filename] = {"fragments": fragments, "stat": self._stat(filename)}
+        self.changed = True
+
+    def save(self) -> None:
+        if not self.changed:
+            return
+        try:
+            write_json(self.path, {"version": 2, "files": self.files})
+        except OSError as e:
+            print(f"Warning: could not write `{self.path}`: {e}", file=sys.stderr)
 # ~\~ end
 # ~\~ begin <<lit/filters.md|tangle-finalize>>[init]
+from concurrent.futures import (ThreadPoolExecutor)
+from itertools import (islice)
+import shutil
+
+write_jobs = 8
+
 def get_file_map(code_map: CodeMap) -> Dict[str, str]:
     """Extracts all file references from `code_map`."""
-    return { code[0].attributes["file"]: codename 
-             for codename, code in code_map.items()
-             if "file" in code[0].attributes }
+    return dict(code_map.files)
 # ~\~ end
 # ~\~ begin <<lit/filters.md|tangle-finalize>>[1]
-def write_file(filename: str, text: str) -> None:
-    """Writes `text` to file `filename`, only if `text` is different
-    from contents of `filename`."""
+def encode_lines(lines: Iterable[str], chunk_size: int = 1024) -> Iterator[bytes]:
+    """Yields `lines`, separated by newlines and encoded as UTF-8, in chunks
+    of `chunk_size` lines."""
+    it = iter(lines)
+    chunk = list(islice(it, chunk_size))
+    sep = b""
+    while chunk:
+        yield sep + "\n".join(chunk).encode("utf-8")
+        sep = b"\n"
+        chunk = list(islice(it, chunk_size))
+# ~\~ end
+# ~\~ begin <<lit/filters.md|tangle-finalize>>[2]
+def open_existing(path: Path) -> Optional[BinaryIO]:
     try:
-        content = open(filename).read()
-        if content == text:
-            return
+        return open(path, "rb")
     except FileNotFoundError:
-        pass
-    print(f"Writing `{filename}`.", file=sys.stderr)
-    open(filename, 'w').write(text)
-
-def finalize(doc: Doc) -> None:
-    """Writes all file references found in `doc.code_map` to disk.
-    This only overwrites a file if the content is different."""
-    file_map = get_file_map(doc.code_map)
-    for filename, codename in file_map.items():
-        write_file(filename, get_code(doc.code_map, codename))
+        return None
+
+def copy_head(src: BinaryIO, dst: BinaryIO, size: int, block_size: int = 1 << 16) -> None:
+    """Copies the first `size` bytes of `src` to `dst`."""
+    src.seek(0)
+    while size > 0:
+        block = src.read(min(block_size, size))
+        if not block:
+            break
+        dst.write(block)
+        size -= len(block)
+
+def update_file(filename: str, lines: Iterable[str], chunk_size: int = 1024) -> bool:
+    """Writes `lines`, separated by newlines, to `filename`, only if that
+    changes the contents of `filename`. Returns whether the file was written."""
+    path = Path(filename)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    size = 0
+    old = open_existing(path)
+    out: Optional[BinaryIO] = None
+    try:
+        for data in encode_lines(lines, chunk_size):
+            if out is None and old is not None and old.read(len(data)) == data:
+                size += len(data)
+                continue
+            if out is None:
+                out = open(tmp, "wb")
+                if old is not None:
+                    copy_head(old, out, size)
+            out.write(data)
+            size += len(data)
+        if out is None:
+            if old is not None and not old.read(1):
+                return False
+            out = open(tmp, "wb")
+            if old is not None:
+                copy_head(old, out, size)
+        out.close()
+        print(f"Writing `{path}`.", file=sys.stderr)
+        if old is not None:
+            shutil.copymode(path, tmp)
+        os.replace(tmp, path)
+        return True
+    finally:
+        if old is not None:
+            old.close()
+        if out is not None:
+            out.close()
+        tmp.unlink(missing_ok=True)
+# ~\~ end
+# ~\~ begin <<lit/filters.md|tangle-finalize>>[3]
+def write_files(doc: "Doc") -> None:
+    """Writes all file references found in `doc.code_map` to disk."""
+    tangle_files(doc.code_map, get_expander(doc), get_timing(doc))
+
+def tangle_files(code_map: CodeMap, expander: Expander, timing: Timing) -> None:
+    """Writes all file references found in `code_map` to disk.
+    This only overwrites a file if the content is different. Files
+    that did not change since the last run, according to the tangle
+    index, are not expanded at all."""
+    file_map = get_file_map(code_map)
+    with timing.phase("tangle.validate"):
+        problems = check_references(code_map, file_map.values())
+    if problems:
+        raise InvalidDocument(problems)
+    with timing.phase("tangle.index"):
+        graph = ReferenceGraph(code_map)
+        index = TangleIndex.load()
+        pending = [(filename, codename, fragments)
+                   for filename, codename in file_map.items()
+                   for fragments in [graph.dependencies(codename)]
+                   if not index.is_current(filename, fragments)]
+
+    def write(job: Tuple[str, str, Dict[str, str]]) -> bool:
+        filename, codename, _ = job
+        return update_file(filename, expander.fork().lines(codename))
+
+    with timing.phase("tangle.write"):
+        with ThreadPoolExecutor(max_workers=min(write_jobs, len(pending) or 1)) as pool:
+            written = sum(pool.map(write, pending))
+    for filename, _, fragments in pending:
+        index.update(filename, fragments)
+    index.save()
+    if file_map:
+        print(f"Tangled {len(file_map)} files: {written} written, "
+              f"{len(file_map) - written} unchanged.", file=sys.stderr)
+
+def finalize(doc: "Doc") -> None:
+    """Writes all files, and leaves an empty document."""
+    write_files(doc)
     doc.content = []
 # ~\~ end
 
-def main(doc: Optional[Doc] = None) -> None:
-    run_filter(
-        action, prepare=prepare, finalize=finalize, doc=doc)
+def main(doc: Optional["Doc"] = None) -> None:
+    from .document import (run_filters)
+    run_filters(
+        [action], prepare=prepare, finalize=finalize, doc=doc)
 # ~\~ end
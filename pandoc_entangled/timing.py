@@ -0,0 +1,121 @@
+# ~\~ language=Python filename=pandoc_entangled/timing.py
+# ~\~ begin <<lit/filters.md|pandoc_entangled/timing.py>>[init]
+from contextlib import contextmanager
+from pathlib import (Path)
+from typing import (Any, Dict, Iterator, Optional, TYPE_CHECKING)
+
+import os
+import sys
+import time
+
+from .cache import (cache_path, write_json)
+
+if TYPE_CHECKING:
+    from panflute import (Doc)
+
+
+def output_path(value: Any, default: str) -> Optional[Path]:
+    """Interprets a timing or profile setting: `None` or a false value
+    disables the output, a true value writes to `default` in the cache
+    directory, and anything else is taken as a file name."""
+    if value is None or value is False:
+        return None
+    if value is True:
+        return cache_path(default)
+    text = str(value).strip()
+    if text.lower() in ("", "0", "false", "no", "off"):
+        return None
+    if text.lower() in ("1", "true", "yes", "on"):
+        return cache_path(default)
+    return Path(text)
+
+
+class Timing:
+    """Records the time spent in the phases of a filter run."""
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self.report_path = output_path(os.environ.get("ENTANGLED_TIMING"), "timing.json")
+        self.profile_path = output_path(os.environ.get("ENTANGLED_PROFILE"), "profile.prof")
+        self.profiler: Any = None
+        self.start_profiler()
+
+    @property
+    def enabled(self) -> bool:
+        return self.report_path is not None
+
+    def configure(self, doc: "Doc") -> None:
+        """Reads the settings from the document metadata, unless they
+        were given in the environment."""
+        if "ENTANGLED_TIMING" not in os.environ:
+            self.report_path = output_path(doc.get_metadata("entangled.timing", None), "timing.json")
+        if "ENTANGLED_PROFILE" not in os.environ:
+            self.profile_path = output_path(doc.get_metadata("entangled.profile", None), "profile.prof")
+        self.start_profiler()
+
+    def start_profiler(self) -> None:
+        if self.profile_path is not None and self.profiler is None:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def report(self, doc: Optional["Doc"] = None) -> Dict[str, Any]:
+        suites = getattr(doc, "suites", None) or {}
+        return {
+            "total": time.perf_counter() - self.start,
+            "phases": self.phases,
+            "suites": {name: s.timings() for name, s in suites.items()}}
+
+    def finish(self, doc: Optional["Doc"] = None) -> None:
+        """Writes the profile and the timing report, if they were asked for."""
+        if self.profiler is not None:
+            self.profiler.disable()
+            assert self.profile_path is not None
+            self.profile_path.parent.mkdir(parents=True, exist_ok=True)
+            self.profiler.dump_stats(str(self.profile_path))
+            print(f"Profile written to {self.profile_path}", file=sys.stderr)
+        if self.report_path is None:
+            return
+        report = self.report(doc)
+        write_json(self.report_path, report)
+        print_summary(report)
+        print(f"Timing report written to {self.report_path}", file=sys.stderr)
+
+
+def get_timing(doc: "Doc") -> Timing:
+    """Returns the timing of the current run, or a new one if the filter
+    was not started through `filter_main`."""
+    timing = getattr(doc, "timing", None)
+    if timing is None:
+        timing = doc.timing = Timing()
+    return timing
+
+# ~\~ begin <<lit/filters.md|timing-summary>>[init]
+def print_summary(report: Dict[str, Any], slowest: int = 5) -> None:
+    out = sys.stderr
+    print(f"Timing: {report['total']:.3f}s total", file=out)
+    for name, t in report["phases"].items():
+        print(f"  {name:<24} {t:9.3f}s", file=out)
+    suites = report["suites"]
+    if not suites:
+        return
+    tests = [(name, i, t) for name, s in suites.items() for i, t in enumerate(s["tests"])]
+    print(f"  {len(suites)} suites ({sum(s['cached'] for s in suites.values())} cached), "
+          f"{len(tests)} tests", file=out)
+    print(f"  kernel startup {sum(s['kernel_startup'] for s in suites.values()):.3f}s, "
+          f"tests {sum(t['elapsed'] for _, _, t in tests):.3f}s, "
+          f"{sum(t['messages'] for _, _, t in tests)} messages, "
+          f"{sum(t['output'] for _, _, t in tests)} characters of output", file=out)
+    for name, i, t in sorted(tests, key=lambda x: -x[2]["elapsed"])[:slowest]:
+        if t["elapsed"] > 0:
+            print(f"    {name}[{i}] {t['elapsed']:.3f}s, {t['messages']} messages", file=out)
+# ~\~ end
+# ~\~ end
@@ -1,10 +1,11 @@
 # ~\~ language=Python filename=pandoc_entangled/typing.py
 # ~\~ begin <<lit/filters.md|pandoc_entangled/typing.py>>[init]
-from typing import (Union, List, Dict, Callable, Any)
-from panflute import (Element, Doc, CodeBlock)
+from typing import (Union, List, Callable, Any, TYPE_CHECKING)
 
-ActionReturn = Union[Element, List[Element], None]
-Action = Callable[[Element, Doc], ActionReturn]
-CodeMap = Dict[str, List[CodeBlock]]
+if TYPE_CHECKING:
+    from panflute import (Element, Doc)
+
+ActionReturn = Union["Element", List["Element"], None]
+Action = Callable[["Element", "Doc"], ActionReturn]
 JSONType = Any
 # ~\~ end
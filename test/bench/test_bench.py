@@ -0,0 +1,42 @@
+from pathlib import (Path)
+from subprocess import (run)
+
+import json
+import sys
+
+root = Path(__file__).resolve().parent.parent.parent
+
+
+def test_generate():
+    sys.path.insert(0, str(root))
+    try:
+        from bench.generate import (Params, generate)
+    finally:
+        sys.path.remove(str(root))
+    md = generate(Params(blocks=50, fanout=3, depth=2, suites=2, tests=3, inject=4))
+    assert md.count("``` {") == 50 + 2 * (1 + 3) + 4
+    assert md.count("file=") == 4
+
+
+def test_bench_quick(tmp_path):
+    output = tmp_path / "report.json"
+    run([sys.executable, "-m", "bench.run", "--quick", "--output", str(output),
+         "tangle", "annotate", "bootstrap", "inject", "doctest"],
+        cwd=root, check=True, capture_output=True)
+    report = json.loads(output.read_text())
+    assert [case["name"] for case in report["cases"]] == \
+        ["tangle", "annotate", "bootstrap", "inject", "doctest"]
+    for case in report["cases"]:
+        assert set(case["time"]) == {"load", "collect", "prepare", "action", "finalize",
+                                     "dump", "total"}
+        assert case["peak_memory"] > 0
+
+
+def test_bench_markdown(tmp_path):
+    output = tmp_path / "report.json"
+    run([sys.executable, "-m", "bench.markdown", "--quick", "--output", str(output)],
+        cwd=root, check=True, capture_output=True)
+    report = json.loads(output.read_text())
+    assert len(report) == 3
+    assert all(case["files"] > 0 and set(case["time"]) == {"pandoc", "markdown"}
+               for case in report)
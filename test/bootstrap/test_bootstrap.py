@@ -41,3 +41,70 @@ def test_bootstrap_filter(tmp_path):
     copyfile(res / "some_blog.md", tmp_path / "some_blog.md")
     run(["pandoc", "-t", "html5", "--filter", "pandoc-bootstrap",
          "./some_blog.md"], cwd=tmp_path, check=True)
+
+
+def test_dhall_batch(tmp_path, monkeypatch):
+    import json
+    import os
+    from pandoc_entangled.bootstrap import parse_dhall_batch
+
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    fake = bin_dir / "dhall-to-json"
+    fake.write_text(f"#!/bin/sh\ncat >> {tmp_path / 'calls'}\nprintf '\\n#\\n' >> {tmp_path / 'calls'}\n"
+                    f"cat {tmp_path / 'out.json'}\n")
+    fake.chmod(0o755)
+    (tmp_path / "out.json").write_text(json.dumps({"deck0": [1], "deck1": [2]}))
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ["PATH"])
+    monkeypatch.setenv("ENTANGLED_CACHE_DIR", str(tmp_path / "cache"))
+
+    def calls():
+        path = tmp_path / "calls"
+        return path.read_text().count("\n#\n") if path.exists() else 0
+
+    assert parse_dhall_batch(["[1]", "[2]", "[1]"], cwd=tmp_path) == [[1], [2], [1]]
+    assert calls() == 1
+    assert "deck0 =\n(\n[1]\n)" in (tmp_path / "calls").read_text()
+    assert parse_dhall_batch(["[2]", "[1]"], cwd=tmp_path) == [[2], [1]]
+    assert calls() == 1
+
+
+def test_convert_card_texts(monkeypatch):
+    import json
+    import panflute
+    from pandoc_entangled import bootstrap
+    from panflute.elements import from_json
+
+    calls = []
+
+    def convert_text(*args, **kwargs):
+        calls.append(args)
+        return panflute.convert_text(*args, **kwargs)
+
+    monkeypatch.setattr(bootstrap, "convert_text", convert_text)
+    texts = ["Some **bold** text.\n", "::: {.note}\nInside a div.\n:::\n",
+             "Some **bold** text.\n", "- one\n- two\n"]
+    converted = bootstrap.convert_card_texts(texts)
+    assert len(calls) == 1
+    assert len(converted) == 3
+    for text in texts:
+        blocks = json.loads(converted[text], object_hook=from_json)
+        assert repr(blocks) == repr(panflute.convert_text(text))
+
+
+def test_convert_card_texts_isolated():
+    import json
+    import panflute
+    from pandoc_entangled import bootstrap
+    from panflute.elements import from_json
+
+    texts = ["# Intro\n\nFirst card.\n", "# Intro\n\nSecond card.\n",
+             "See [the docs][docs].\n\n[docs]: https://example.com\n",
+             "Where are [the docs][docs]?\n", "A note[^1].\n\n[^1]: Here.\n",
+             "Title\n=====\n\nText.\n", "Plain *text*.\n"]
+    converted = bootstrap.convert_card_texts(texts)
+    for text in texts:
+        separate = panflute.convert_text(text)
+        if text in converted:
+            assert repr(json.loads(converted[text], object_hook=from_json)) == repr(separate)
+    assert set(converted) == {"Where are [the docs][docs]?\n", "Plain *text*.\n"}
@@ -0,0 +1,63 @@
+from pandoc_entangled.config import (Config, read_config, get_language_info)
+
+import json
+import os
+import pytest
+
+
+CONFIG = {"entangled": {"languages": [
+              {"name": "Python", "identifiers": ["python", "py"]},
+              {"name": "C++", "identifiers": ["cpp", "c++"]}]},
+          "jupyter": [{"language": "Python", "kernel": "python3"}]}
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    """A project directory with a fake `dhall-to-json` that counts its calls."""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    fake = bin_dir / "dhall-to-json"
+    fake.write_text(f"#!/bin/sh\necho x >> {tmp_path / 'calls'}\ncat {tmp_path / 'out.json'}\n")
+    fake.chmod(0o755)
+    (tmp_path / "out.json").write_text(json.dumps(CONFIG))
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ["PATH"])
+    monkeypatch.delenv("ENTANGLED_CACHE_DIR", raising=False)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def calls(project):
+    path = project / "calls"
+    return len(path.read_text().splitlines()) if path.exists() else 0
+
+
+def test_config_cache(project):
+    (project / "entangled.dhall").write_text("./languages.dhall")
+    (project / "languages.dhall").write_text("{ a = 1 }")
+    assert read_config() == CONFIG
+    assert read_config() == CONFIG
+    assert calls(project) == 1
+
+    (project / "languages.dhall").write_text("{ a = 2 }")
+    read_config()
+    assert calls(project) == 2
+
+    (project / "entangled.dhall").write_text("https://example.com/config.dhall")
+    read_config()
+    read_config()
+    assert calls(project) == 4
+
+
+def test_config_json_fallback(project):
+    (project / "entangled.json").write_text(json.dumps(CONFIG))
+    assert read_config() == CONFIG
+    assert calls(project) == 0
+
+
+def test_language_index():
+    config = Config(CONFIG)
+    assert get_language_info(config, "py") == {"jupyter": "python3", **CONFIG["entangled"]["languages"][0]}
+    assert get_language_info(config, "cpp")["jupyter"] is None
+    assert get_language_info(CONFIG, "python")["name"] == "Python"
+    with pytest.raises(ValueError):
+        get_language_info(config, "haskell")
@@ -0,0 +1,120 @@
+from pandoc_entangled.doctest import (Test, handle)
+from pandoc_entangled import doctest
+
+import sys
+import time
+import pytest
+
+
+def message(msg_type, content, msg_id="cell"):
+    return {"msg_type": msg_type, "parent_header": {"msg_id": msg_id}, "content": content}
+
+
+def chatty_cell(n):
+    return [message("status", {"execution_state": "busy"}),
+            message("execute_input", {"code": "...", "execution_count": 1})] \
+        + [message("stream", {"name": "stdout", "text": f"{i}\n"}) for i in range(n)] \
+        + [message("status", {"execution_state": "idle"})]
+
+
+def pampy_handle(test, msg_id, msg):
+    """The pattern matcher that was used before the dispatch table."""
+    from pampy import match, _
+
+    def stream_text(data):
+        test.result = test.result or ""
+        test.result += data
+        return False
+
+    def status_idle(_):
+        if test.expect is None:
+            test.status = doctest.TestStatus.SUCCESS
+        return True
+
+    return match(msg
+        , { "msg_type": "execute_result"
+          , "parent_header": { "msg_id" : msg_id }
+          , "content": { "data" : { "text/plain": _ } } }
+        , stream_text
+        , { "msg_type": "stream"
+          , "parent_header": { "msg_id" : msg_id }
+          , "content": { "text": _ } }
+        , stream_text
+        , { "msg_type": "display_data"
+          , "parent_header": { "msg_id" : msg_id }
+          , "content": { "data": { "text/plain": _ } } }
+        , stream_text
+        , { "msg_type": "status"
+          , "parent_header": { "msg_id" : msg_id }
+          , "content": { "execution_state": "idle" } }
+        , status_idle
+        , { "msg_type": "error"
+          , "parent_header": { "msg_id" : msg_id }
+          , "content": { "traceback": _ } }
+        , status_idle
+        , _
+        , lambda x: False
+        )
+
+
+def run_handler(handler, msgs):
+    test = Test("", None)
+    handled = 0
+    for msg in msgs:
+        handled += 1
+        if handler(test, "cell", msg):
+            break
+    return test, handled
+
+
+def messages_per_second(handler, msgs):
+    start = time.perf_counter()
+    test, _ = run_handler(handler, msgs)
+    elapsed = time.perf_counter() - start
+    assert test.status is doctest.TestStatus.SUCCESS
+    return len(msgs) / elapsed
+
+
+def test_dispatch_same_as_pampy():
+    pytest.importorskip("pampy")
+    msgs = chatty_cell(100)
+    old, old_count = run_handler(pampy_handle, msgs)
+    new, new_count = run_handler(handle, msgs)
+    assert old.status is new.status is doctest.TestStatus.SUCCESS
+    assert old_count == new_count == len(msgs)
+    assert new.result == old.result == "".join(f"{i}\n" for i in range(100))
+
+
+@pytest.mark.benchmark
+def test_dispatch_benchmark():
+    pytest.importorskip("pampy")
+    msgs = chatty_cell(20000)
+    before = messages_per_second(pampy_handle, msgs)
+    after = messages_per_second(handle, msgs)
+    print(f"\nmessage dispatch: pampy {before:,.0f} msg/s, table {after:,.0f} msg/s",
+          file=sys.stderr)
+    assert after > before
+
+
+def test_dispatch_output():
+    test = Test("", None)
+    msgs = [
+        message("stream", {"name": "stdout", "text": "a\n"}),
+        message("display_data", {"data": {"text/plain": "<1>"}, "transient": {"display_id": "p"}}),
+        message("stream", {"name": "stdout", "text": "b\n"}, msg_id="other"),
+        message("stream", {"name": "stdout", "text": "c\n"}),
+        message("update_display_data", {"data": {"text/plain": "<100>"}, "transient": {"display_id": "p"}}),
+        message("update_display_data", {"data": {"text/plain": "<2>"}, "transient": {"display_id": "p"}}),
+    ]
+    for msg in msgs:
+        assert not handle(test, "cell", msg)
+    assert test.output.value() == "a\n<2>c\n"
+
+    handle(test, "cell", message("clear_output", {"wait": True}))
+    assert test.output.value() == "a\n<2>c\n"
+    handle(test, "cell", message("stream", {"name": "stdout", "text": "d\n"}))
+    assert test.output.value() == "d\n"
+    handle(test, "cell", message("clear_output", {"wait": False}))
+    assert test.result is None
+    assert handle(test, "cell", message("status", {"execution_state": "idle"}))
+    assert test.result == ""
@@ -1,4 +1,4 @@
-from pandoc_entangled.doctest import (Suite, Test, run_suite)
+from pandoc_entangled.doctest import (Suite, Test, RunOptions, run_suite)
 from pandoc_entangled.config import (read_config)
 from pandoc_entangled import (doctest, tangle)
 from panflute import (convert_text, Div)
@@ -10,6 +10,7 @@ from contextlib import contextmanager
 
 import pytest
 import os
+import time
 
 def test_suite():
     config = read_config()
@@ -17,6 +18,120 @@ def test_suite():
     run_suite(config, suite)
     assert suite.code_blocks[0].expect == suite.code_blocks[0].result
 
+def test_suites_concurrent():
+    import asyncio
+    from pandoc_entangled.doctest import (run_suites)
+    TestStatus = doctest.TestStatus
+    config = read_config()
+    suites = [Suite([Test(f"x = {i}", None), Test("x * 2", str(2 * i))], "python")
+              for i in range(5)]
+    suites.append(Suite([Test("1/0", "1"), Test("1", "1")], "python"))
+    asyncio.run(run_suites(config, suites, 3))
+    for i, s in enumerate(suites[:5]):
+        assert s.code_blocks[1].result == str(2 * i)
+        assert s.code_blocks[1].status is TestStatus.SUCCESS
+    assert suites[5].code_blocks[0].status is TestStatus.ERROR
+    assert suites[5].code_blocks[1].status is TestStatus.PENDING
+
+def test_suite_pipelined():
+    TestStatus = doctest.TestStatus
+    config = read_config()
+    tests = [Test(f"print({i})", None) for i in range(50)] \
+        + [Test("21 * 2", "42"), Test("1/0", "0"), Test("print('unreachable')", None)]
+    suite = Suite(tests, "python")
+    run_suite(config, suite, RunOptions(window=16))
+    assert all(t.result == f"{i}\n" for i, t in enumerate(tests[:50]))
+    assert [t.status for t in tests[49:]] == \
+        [TestStatus.SUCCESS, TestStatus.SUCCESS, TestStatus.ERROR, TestStatus.PENDING]
+    assert tests[-1].result is None
+
+def test_engine_overlap():
+    from pandoc_entangled.doctest import (Engine)
+    TestStatus = doctest.TestStatus
+    config = read_config()
+    fast = Suite([Test("6*7", "42")], "python")
+    slow = Suite([Test("import time", None), Test("time.sleep(3)", None), Test("1", "1")],
+                 "python")
+    saved = []
+    engine = Engine(config, [slow, fast], 2, on_done=saved.append).start()
+    engine.wait(fast.code_blocks[0])
+    assert fast.code_blocks[0].status is TestStatus.SUCCESS
+    assert not slow.code_blocks[-1].done.is_set()
+    engine.join()
+    assert slow.code_blocks[-1].status is TestStatus.SUCCESS
+    assert saved == [fast, slow]
+
+def test_suite_timeout():
+    TestStatus = doctest.TestStatus
+    config = read_config()
+    tests = [Test("import time, signal", None), Test("time.sleep(60)", None), Test("1", "1")]
+    suite = Suite(tests, "python")
+    run_suite(config, suite, RunOptions(timeout=1))
+    assert tests[0].status is TestStatus.SUCCESS
+    assert tests[1].status is TestStatus.ERROR
+    assert tests[1].error.startswith("Timed out after")
+    assert tests[2].status is TestStatus.PENDING
+
+    tests = [Test("signal.signal(signal.SIGINT, signal.SIG_IGN)", None),
+             Test("time.sleep(60)", None)]
+    tests = [Test("import time, signal", None)] + tests
+    suite = Suite(tests, "python")
+    start = time.monotonic()
+    run_suite(config, suite, RunOptions(timeout=1, interrupt_grace=1))
+    assert time.monotonic() - start < 30
+    assert tests[2].status is TestStatus.ERROR
+
+    tests = [Test("time.sleep(0.5)", None) for _ in range(10)]
+    suite = Suite([Test("import time", None)] + tests, "python")
+    run_suite(config, suite, RunOptions(suite_timeout=2))
+    assert any(t.status is TestStatus.ERROR for t in tests)
+    assert tests[-1].status is TestStatus.PENDING
+
+def test_output_buffer():
+    from pandoc_entangled.doctest import OutputBuffer
+    buf = OutputBuffer(limit=10)
+    assert buf.value() is None
+    for i in range(100):
+        buf.append(str(i % 10))
+    assert buf.value() == "01234\n[... 90 characters elided ...]\n56789"
+    assert buf.size == 10
+
+    buf = OutputBuffer(limit=20)
+    buf.append("abc")
+    buf.append("<x>", display_id="d")
+    buf.update("d", "<y>")
+    assert buf.value() == "abc<y>"
+    buf.append("0123456789" * 3)
+    buf.append("<t>", display_id="t")
+    buf.append("0123456789")
+    buf.update("d", "<z>")
+    buf.update("t", "<u>")
+    assert buf.value() == "abc<z>0123\n[... 29 characters elided ...]\n0123456789"
+
+def test_output_limits():
+    config = read_config()
+    options = RunOptions(output_limit=100, suite_output_limit=150)
+    tests = [Test("print('x' * 1000)", None), Test("print('y' * 1000)", None),
+             Test("print('z')", None)]
+    run_suite(config, Suite(tests, "python"), options)
+    assert tests[0].elided == 901
+    assert tests[0].result.startswith("x" * 50) and tests[0].result.endswith("x" * 49 + "\n")
+    assert tests[1].elided == 951
+    assert tests[2].elided == 2 and tests[2].result == "\n[... 2 characters elided ...]\n"
+
+def test_setting():
+    from pandoc_entangled.config import get_setting
+    doc = convert_text("---\ndoctest:\n  jobs: 8\n---\n", standalone=True)
+    doc.config = {"doctest": {"jobs": 2, "timeout": 10}}
+    assert get_setting(doc, "doctest", "jobs", 1) == 8
+    assert get_setting(doc, "doctest", "timeout", 1.0) == 10.0
+    assert get_setting(doc, "doctest", "missing", "x") == "x"
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """Keeps the caches of every test, and of the filters it runs, in `tmp_path`."""
+    monkeypatch.setenv("ENTANGLED_CACHE_DIR", str(tmp_path / "cache"))
+
 def count_status_prepare(doc):
     doc.report = defaultdict(lambda: 0)
 
@@ -40,7 +155,10 @@ def run_doctest(doc):
     doc = doc.walk(tangle.action)
     
     doctest.prepare(doc)
-    doc = doc.walk(doctest.action)
+    try:
+        doc = doc.walk(doctest.action)
+    finally:
+        doctest.finalize(doc)
 
     count_status_prepare(doc)
     doc = doc.walk(count_status_action)
@@ -113,3 +231,88 @@ def test_doctest_no_kernel_configured(tmp_path):
     doc = convert_text(Path(res / "no_kernel_configured.md").read_text(), standalone=True)
     with pytest.raises(RuntimeError):
         run_doctest(doc)
+
+def test_doctest_validate(monkeypatch):
+    from pandoc_entangled.markdown import read_code_map
+    res = Path.resolve(Path(__file__)).parent
+    def no_kernel(kernel_name):
+        raise AssertionError("No kernel should be started.")
+    monkeypatch.setattr(doctest, "start_kernel", no_kernel)
+
+    doc = convert_text(Path(res / "invalid.md").read_text(), standalone=True)
+    with pytest.raises(doctest.InvalidDocument) as e:
+        run_doctest(doc)
+    assert [p.location for p in e.value.problems] == \
+        ["«missing»", "«loop-body»", "«nolang»", "«nosep»"]
+
+    path = res / "invalid.md"
+    code_map = read_code_map([path])
+    problems = doctest.check_doc_tests(read_config(), code_map)
+    assert [p.location for p in problems] == [f"{path}:{n}" for n in (4, 15, 18, 24)]
+    assert "`nowhere`" in problems[0].message
+    assert "`loop` -> `loop-body` -> `loop`" in problems[1].message
+    assert "`doctest` of code block `nolang` not found in config" in problems[2].message
+    kernels = doctest.check_kernels(read_config(), [code_map["scheme"][0], code_map["nosep"][0]])
+    assert [p.location for p in kernels] == [f"{path}:29"]
+    assert kernels[0].message.startswith("Can't run code block `scheme`: ")
+
+def test_result_cache(tmp_path, monkeypatch):
+    from pandoc_entangled.doctest import ResultCache
+    from pandoc_entangled.cache import Store
+    config = read_config()
+    cache = ResultCache(Store(tmp_path, 2**20))
+
+    suite = Suite([Test("print('hi')", None), Test("6*7", "42")], "python")
+    assert not cache.restore(config, suite)
+    run_suite(config, suite)
+    cache.save(config, suite)
+
+    again = Suite([Test("print('hi')", None), Test("6*7", "42")], "python")
+    assert cache.restore(config, again)
+    assert again == suite
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    changed = Suite([Test("print('hi')", None), Test("6*7", "43")], "python")
+    assert not cache.restore(config, changed)
+
+def test_result_cache_context(tmp_path, monkeypatch):
+    from pandoc_entangled.doctest import ResultCache
+    from pandoc_entangled.cache import Store
+    from pandoc_entangled.tangle import CodeMap, Fragment
+    from panflute import Doc
+    monkeypatch.setenv("ENTANGLED_CACHE_DIR", str(tmp_path))
+    monkeypatch.delenv("ENTANGLED_DOCTEST_CACHE", raising=False)
+    config = read_config()
+
+    def key(library, timeout):
+        doc = Doc()
+        doc.code_map = CodeMap()
+        doc.code_map.add(Fragment("lib.py", "<<body>>", file="lib.py"))
+        doc.code_map.add(Fragment("body", library))
+        doc.code_map.add(Fragment("unrelated", library))
+        cache = ResultCache.from_doc(doc, RunOptions(timeout=timeout))
+        return cache.key(config, Suite([Test("import lib", None)], "python"))
+
+    assert key("x = 1", 10) == key("x = 1", 10)
+    assert key("x = 2", 10) != key("x = 1", 10)
+    assert key("x = 1", 20) != key("x = 1", 10)
+
+    cache = ResultCache(Store(tmp_path / "results", 2**20))
+    failed = Suite([Test("1/0", None), Test("6*7", "42")], "python")
+    run_suite(config, failed)
+    cache.save(config, failed)
+    assert not cache.restore(config, Suite([Test("1/0", None), Test("6*7", "42")], "python"))
+
+def test_store_eviction(tmp_path):
+    from pandoc_entangled.cache import Store
+    import time
+    store = Store(tmp_path, 100)
+    store.put("a", "x" * 40)
+    time.sleep(0.01)
+    store.put("b", "y" * 40)
+    time.sleep(0.01)
+    assert store.get("a") is not None
+    store.put("c", "z" * 40)
+    assert store.get("b") is None
+    assert store.get("a") is not None
+    assert store.get("c") is not None
@@ -0,0 +1,62 @@
+from pandoc_entangled.doctest import (Suite, Test, RunOptions, run_suite)
+from pandoc_entangled import doctest
+from pandoc_entangled.config import (read_config)
+from pandoc_entangled.kernel_pool import (KernelPool, serve)
+
+import asyncio
+import threading
+import time
+
+
+class CountingPool(KernelPool):
+    def __init__(self, size):
+        super().__init__(size)
+        self.handed_out = 0
+
+    async def acquire(self, kernel_name):
+        km = await super().acquire(kernel_name)
+        self.handed_out += 1
+        return km
+
+
+def test_kernel_pool(tmp_path, monkeypatch):
+    path = tmp_path / "pool.sock"
+    monkeypatch.setenv("ENTANGLED_KERNEL_POOL", str(path))
+    pool = CountingPool(size=1)
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(serve(path, pool, ["python3"]))
+
+    def run_loop():
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+
+    thread = threading.Thread(target=run_loop)
+    thread.start()
+    try:
+        while not path.exists():
+            time.sleep(0.01)
+
+        config = read_config()
+        for _ in range(2):
+            suite = Suite([Test("x = globals().get('x', 0) + 1", None), Test("x", "1")], "python")
+            run_suite(config, suite)
+            assert suite.code_blocks[1].status is doctest.TestStatus.SUCCESS
+        assert pool.handed_out == 2
+
+        suite = Suite([Test("import time; time.sleep(60)", None)], "python")
+        run_suite(config, suite, RunOptions(timeout=1))
+        assert suite.code_blocks[0].error.startswith("Timed out after")
+    finally:
+        loop.call_soon_threadsafe(task.cancel)
+        thread.join()
+        loop.close()
+    assert not path.exists()
+
+
+def test_no_kernel_pool(tmp_path, monkeypatch):
+    monkeypatch.setenv("ENTANGLED_KERNEL_POOL", str(tmp_path / "missing.sock"))
+    suite = Suite([Test("6*7", "42")], "python")
+    run_suite(read_config(), suite)
+    assert suite.code_blocks[0].status is doctest.TestStatus.SUCCESS
@@ -0,0 +1,75 @@
+from pandoc_entangled.doctest import (Test, generate_report, ansi_to_html)
+from pandoc_entangled import doctest
+from panflute import (CodeBlock, RawBlock)
+
+import pytest
+import sys
+import time
+
+
+def old_generate_report(elem, t):
+    """The report generator that created a converter for every code block."""
+    from ansi2html import Ansi2HTMLConverter
+    conv = Ansi2HTMLConverter(inline=True)
+    return conv.convert(t.result, full=False), conv.convert(t.expect, full=False)
+
+
+def make_tests(n):
+    tests = []
+    for i in range(n):
+        t = Test(f"f({i % 10})", f"<{i % 10}> & more\n")
+        t.result = f"<{i % 7}> & more\n" if i % 3 else "\x1b[31mError\x1b[0m <x>\n"
+        t.status = doctest.TestStatus.FAIL
+        tests.append(t)
+    return tests
+
+
+def raw_html(elem):
+    found = []
+    elem.walk(lambda e, doc: found.append(e.text) if isinstance(e, RawBlock) else None)
+    return found
+
+
+def test_ansi_to_html():
+    from ansi2html import Ansi2HTMLConverter
+    conv = Ansi2HTMLConverter(inline=True)
+    for text in ["a<b>&\"'c\n  x\n", "", "\x1b[1;32mok\x1b[0m <b>\n", "plain\ttext\r\n"]:
+        assert ansi_to_html(text) == conv.convert(text, full=False)
+
+
+def test_report_shared_converter():
+    tests = make_tests(300)
+    elem = CodeBlock("f(1)\n---\n1", classes=["python", "doctest"])
+    expected = [old_generate_report(elem, t) for t in tests]
+    doctest.ansi_converter.cache_clear()
+    doctest.memo_convert_ansi.cache_clear()
+    reports = [generate_report(elem, t) for t in tests]
+    for report, (result, expect) in zip(reports, expected):
+        assert raw_html(report) == [f'<pre class="ansi2html-content">{result}</pre>',
+                                    f'<pre class="ansi2html-content">{expect}</pre>']
+    assert doctest.ansi_converter.cache_info().misses == 1
+    assert doctest.memo_convert_ansi.cache_info().misses == len({t.result for t in tests} |
+                                                                {t.expect for t in tests})
+
+
+def test_ansi_to_html_long_text():
+    doctest.memo_convert_ansi.cache_clear()
+    long_text = "\x1b[1mx\x1b[0m <" * doctest.memo_limit
+    assert ansi_to_html(long_text) == doctest.convert_ansi(long_text)
+    assert ansi_to_html("short <") == "short &lt;"
+    assert doctest.memo_convert_ansi.cache_info().currsize == 1
+
+
+@pytest.mark.benchmark
+def test_report_benchmark():
+    tests = make_tests(300)
+    elem = CodeBlock("f(1)\n---\n1", classes=["python", "doctest"])
+    start = time.perf_counter()
+    [old_generate_report(elem, t) for t in tests]
+    before = time.perf_counter() - start
+    doctest.memo_convert_ansi.cache_clear()
+    start = time.perf_counter()
+    [generate_report(elem, t) for t in tests]
+    after = time.perf_counter() - start
+    print(f"\nreports: per-block converter {before:.3f}s, shared {after:.3f}s", file=sys.stderr)
+    assert after < before
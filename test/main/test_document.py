@@ -0,0 +1,74 @@
+from pandoc_entangled.document import (load_document, dump_document)
+from subprocess import (run)
+
+import gc
+import io
+import sys
+import time
+import tracemalloc
+import panflute
+import pytest
+
+
+def synthetic_markdown(sections):
+    return "\n".join(
+        f"## Section {i}\n\n"
+        + f"Some *emphasis*, **strong** text, `code` and a [link](http://example.com/{i}). " * 4
+        + f"\n\n``` {{.python #fragment-{i}}}\nprint({i})\n```\n\n- one\n- two\n"
+        for i in range(sections))
+
+
+@pytest.fixture(scope="module")
+def big_ast():
+    """A Pandoc AST of a few megabytes."""
+    return run(["pandoc", "-t", "json"], input=synthetic_markdown(1000).encode("utf-8"),
+               capture_output=True, check=True).stdout
+
+
+def panflute_round_trip(data):
+    doc = panflute.load(io.StringIO(data.decode("utf-8")))
+    out = io.StringIO()
+    panflute.dump(doc, out)
+    return out.getvalue().encode("utf-8")
+
+
+def document_round_trip(data):
+    doc = load_document(io.BytesIO(data))
+    out = io.BytesIO()
+    dump_document(doc, out)
+    return out.getvalue()
+
+
+def measure(f, data):
+    elapsed = float("inf")
+    for _ in range(3):
+        gc.collect()
+        start = time.perf_counter()
+        f(data)
+        elapsed = min(elapsed, time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        f(data)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return elapsed, peak
+
+
+def test_round_trip(big_ast):
+    assert document_round_trip(big_ast) == panflute_round_trip(big_ast)
+
+
+def test_document_benchmark(big_ast):
+    before = measure(panflute_round_trip, big_ast)
+    after = measure(document_round_trip, big_ast)
+    print(f"\nAST of {len(big_ast) / 2**20:.1f}MB, round trip: "
+          f"panflute {before[0]:.2f}s {before[1] / 2**20:.0f}MB peak, "
+          f"document {after[0]:.2f}s {after[1] / 2**20:.0f}MB peak", file=sys.stderr)
+    assert after[1] <= before[1]
+
+
+def test_deeply_nested():
+    data = run(["pandoc", "-t", "json"], input=("> " * 150 + "deep\n").encode("utf-8"),
+               capture_output=True, check=True).stdout
+    assert document_round_trip(data) == panflute_round_trip(data)
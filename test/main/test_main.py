@@ -0,0 +1,100 @@
+from pandoc_entangled.main import (FusedWalk, select_filters)
+from panflute import (convert_text, run_filters, CodeBlock, Div, Para, Str, HorizontalRule)
+from pathlib import (Path)
+from shutil import (copyfile)
+from subprocess import (run)
+
+import io
+import json
+import os
+import panflute
+import pytest
+
+source = """
+Some *text* here.
+
+``` {.python #a}
+print("hello")
+```
+
+> A quote, with `code`.
+
+``` {.python #b}
+print("world")
+```
+"""
+
+
+def wrap_code(elem, doc):
+    if isinstance(elem, CodeBlock) and "inner" not in elem.classes:
+        return Div(CodeBlock(elem.text, classes=["inner"]), Para(Str("label")))
+
+
+def split_para(elem, doc):
+    if isinstance(elem, Para):
+        return [elem, HorizontalRule()]
+
+
+def mark_code(elem, doc):
+    if isinstance(elem, CodeBlock):
+        return Div(elem, classes=["marked"])
+
+
+def shout(elem, doc):
+    if isinstance(elem, Str):
+        return Str(elem.text.upper())
+
+
+def to_json(doc):
+    with io.StringIO() as f:
+        panflute.dump(doc, f)
+        return json.loads(f.getvalue())
+
+
+def test_fused_walk():
+    actions = [wrap_code, split_para, mark_code, shout]
+    expected = run_filters(actions, doc=convert_text(source, standalone=True))
+    fused = FusedWalk(actions).run(convert_text(source, standalone=True))
+    assert to_json(fused) == to_json(expected)
+
+
+def test_select_filters(monkeypatch):
+    doc = convert_text("---\nentangled:\n  filters: [inject]\n---\n", standalone=True)
+    monkeypatch.delenv("ENTANGLED_FILTERS", raising=False)
+    assert select_filters(doc) == ["inject"]
+    monkeypatch.setenv("ENTANGLED_FILTERS", "tangle, doctest")
+    assert select_filters(doc) == ["tangle", "doctest"]
+    assert select_filters(doc, "bootstrap") == ["bootstrap"]
+    with pytest.raises(ValueError):
+        select_filters(doc, "tangle,nonsense")
+
+
+def pandoc(path, *filters, env=None, to="html5"):
+    args = ["pandoc", "-t", to, path.name]
+    for f in filters:
+        args += ["--filter", f]
+    environ = {k: v for k, v in os.environ.items() if k != "ENTANGLED_FILTERS"}
+    return run(args, cwd=path.parent, check=True, capture_output=True, encoding="utf-8",
+               env=dict(environ, **(env or {}))).stdout
+
+
+def test_combined_doctest(tmp_path):
+    res = Path.resolve(Path(__file__)).parent.parent
+    copyfile(res / "doctest" / "doctest-python.md", tmp_path / "doctest-python.md")
+    copyfile("entangled.json", tmp_path / "entangled.json")
+    pandoc(tmp_path / "doctest-python.md", "pandoc-tangle", to="plain")
+    assert (tmp_path / "word_count.py").exists()
+    env = {"ENTANGLED_DOCTEST_CACHE": "off"}
+    combined = pandoc(tmp_path / "doctest-python.md", "pandoc-entangled", env=env)
+    separate = pandoc(tmp_path / "doctest-python.md", "pandoc-bootstrap", "pandoc-doctest", env=env)
+    assert "annotated-code" in separate
+    assert combined == separate
+
+
+def test_combined_inject(tmp_path):
+    res = Path.resolve(Path(__file__)).parent.parent
+    copyfile(res / "inject" / "plotly.md", tmp_path / "plotly.md")
+    combined = pandoc(tmp_path / "plotly.md", "pandoc-entangled",
+                      env={"ENTANGLED_FILTERS": "inject"})
+    separate = pandoc(tmp_path / "plotly.md", "pandoc-inject")
+    assert combined == separate
@@ -0,0 +1,70 @@
+from pandoc_entangled.project import (argument_parser, load_documents, output_path, parse_arguments)
+from pathlib import (Path)
+from shutil import (copyfile)
+from subprocess import (run)
+
+import os
+import pytest
+
+first = """
+``` {.python file=hello.py}
+<<greeting>>
+print(message)
+```
+
+``` {.python #session}
+x = 6
+```
+"""
+
+second = """
+``` {.python #greeting}
+message = "Hello"
+```
+
+``` {.python .doctest #session}
+x * 7
+---
+42
+```
+"""
+
+
+def test_output_path():
+    assert output_path("lit/a.md", Path("docs"), "html5") == Path("docs/a.html")
+    assert output_path("b.md", Path("out"), "docx") == Path("out/b.docx")
+
+
+def test_parse_arguments():
+    parser = argument_parser()
+    args, pandoc_args = parse_arguments(parser, [
+        "-o", "docs", "a.md", "b.md", "--", "--toc-depth", "1", "--css", "css/mods.css"])
+    assert args.inputs == ["a.md", "b.md"]
+    assert args.output_dir == Path("docs")
+    assert pandoc_args == ["--toc-depth", "1", "--css", "css/mods.css"]
+    assert parse_arguments(parser, ["a.md"])[1] == []
+    with pytest.raises(SystemExit):
+        parse_arguments(parser, ["--toc-depth", "1", "a.md"])
+
+
+def test_load_documents(tmp_path):
+    (tmp_path / "first.md").write_text(first)
+    (tmp_path / "second.md").write_text(second)
+    paths = [str(tmp_path / "first.md"), str(tmp_path / "second.md")]
+    docs = load_documents(paths, output_format="latex", jobs=2)
+    assert [doc.format for doc in docs] == ["latex", "latex"]
+    assert [doc.source for doc in docs] == paths
+
+
+def test_project(tmp_path):
+    (tmp_path / "first.md").write_text(first)
+    (tmp_path / "second.md").write_text(second)
+    copyfile("entangled.json", tmp_path / "entangled.json")
+    env = dict(os.environ, ENTANGLED_DOCTEST_CACHE="off")
+    env.pop("ENTANGLED_FILTERS", None)
+    run(["pandoc-entangled-project", "-o", "docs", "-t", "html5",
+         "first.md", "second.md", "--", "--standalone", "--toc-depth", "1"], cwd=tmp_path, check=True, env=env)
+    assert (tmp_path / "hello.py").read_text() == 'message = "Hello"\nprint(message)'
+    assert (tmp_path / "docs" / "first.html").read_text().startswith("<!DOCTYPE html>")
+    output = (tmp_path / "docs" / "second.html").read_text()
+    assert 'data-status="SUCCESS"' in output
@@ -0,0 +1,52 @@
+from subprocess import (run)
+
+import json
+import pytest
+import sys
+
+heavy_modules = ["jupyter_client", "zmq", "tornado", "ansi2html", "pkg_resources"]
+
+startup_budget = 0.25   # seconds, spent in our own modules
+
+
+def import_profile(module):
+    """Imports `module` in a fresh interpreter. Returns the modules that were
+    loaded and the import time per module, in seconds."""
+    script = f"import sys, json; import {module}; print(json.dumps(list(sys.modules)))"
+    result = run([sys.executable, "-X", "importtime", "-c", script],
+                 capture_output=True, encoding="utf-8", check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(self_us) / 1e6
+    return json.loads(result.stdout), times
+
+
+entry_modules = ["pandoc_entangled.main", "pandoc_entangled.doctest_main",
+                 "pandoc_entangled.bootstrap", "pandoc_entangled.tangle"]
+
+
+def test_lazy_imports():
+    for module in entry_modules:
+        modules, _ = import_profile(module)
+        assert not [m for m in heavy_modules if m in modules], module
+
+
+@pytest.mark.benchmark
+def test_startup_budget():
+    for module in entry_modules:
+        _, times = import_profile(module)
+        own = sum(t for name, t in times.items() if name.startswith("pandoc_entangled"))
+        assert own < startup_budget, module
+
+
+def test_version():
+    import pandoc_entangled
+    assert isinstance(pandoc_entangled.__version__, str)
+
+
+def test_markdown_without_panflute():
+    modules, _ = import_profile("pandoc_entangled.markdown")
+    assert "panflute" not in modules
@@ -0,0 +1,65 @@
+from pandoc_entangled.timing import (Timing, output_path)
+from pathlib import (Path)
+from shutil import (copyfile)
+from subprocess import (run)
+
+import json
+import os
+
+
+def pandoc(path, *filters, env=None):
+    args = ["pandoc", "-t", "html5", path.name]
+    for f in filters:
+        args += ["--filter", f]
+    return run(args, cwd=path.parent, check=True, capture_output=True, encoding="utf-8",
+               env=dict(os.environ, **(env or {})))
+
+
+def setup_doctest(tmp_path):
+    res = Path.resolve(Path(__file__)).parent.parent
+    copyfile(res / "doctest" / "doctest-python.md", tmp_path / "doctest-python.md")
+    copyfile("entangled.json", tmp_path / "entangled.json")
+    return tmp_path / "doctest-python.md"
+
+
+def test_output_path(monkeypatch):
+    monkeypatch.setenv("ENTANGLED_CACHE_DIR", "cache")
+    assert output_path(None, "timing.json") is None
+    assert output_path("off", "timing.json") is None
+    assert output_path(True, "timing.json") == Path("cache/timing.json")
+    assert output_path("1", "timing.json") == Path("cache/timing.json")
+    assert output_path("out/report.json", "timing.json") == Path("out/report.json")
+
+
+def test_timing_report(tmp_path):
+    path = setup_doctest(tmp_path)
+    report_path = tmp_path / "report.json"
+    result = pandoc(path, "pandoc-entangled",
+                    env={"ENTANGLED_FILTERS": "tangle,doctest", "ENTANGLED_DOCTEST_CACHE": "off", "ENTANGLED_TIMING": str(report_path),
+                         "ENTANGLED_PROFILE": "1", "ENTANGLED_CACHE_DIR": str(tmp_path / "cache")})
+    report = json.loads(report_path.read_text())
+    assert {"load", "collect", "prepare.tangle", "tangle.write", "prepare.doctest", "doctest.run", "actions", "dump"} \
+        <= set(report["phases"])
+    assert report["total"] >= sum(t for name, t in report["phases"].items() if "." not in name)
+    suite = report["suites"]["test-word-count"]
+    assert not suite["cached"]
+    assert suite["kernel_startup"] > 0
+    assert all(t["elapsed"] > 0 and t["messages"] > 0 for t in suite["tests"])
+    assert "Timing:" in result.stderr
+    assert (tmp_path / "cache" / "profile.prof").exists()
+
+
+def test_timing_disabled(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("ENTANGLED_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.delenv("ENTANGLED_TIMING", raising=False)
+    monkeypatch.delenv("ENTANGLED_PROFILE", raising=False)
+    timing = Timing()
+    with timing.phase("work"):
+        pass
+    with timing.phase("work"):
+        pass
+    assert list(timing.phases) == ["work"]
+    assert not timing.enabled
+    timing.finish()
+    assert not (tmp_path / "cache").exists()
@@ -0,0 +1,82 @@
+from pandoc_entangled.markdown import (code_blocks, parse_attributes, read_code_map)
+from pandoc_entangled.tangle import (get_file_map)
+from pandoc_entangled.document import (load_document)
+from panflute import (CodeBlock)
+from pathlib import (Path)
+from subprocess import (run)
+
+import io
+import pytest
+
+res = Path.resolve(Path(__file__)).parent
+root = res.parent.parent
+
+
+def pandoc_code_blocks(path):
+    ast = run(["pandoc", "-f", "markdown", "-t", "json", str(path)],
+              capture_output=True, check=True).stdout
+    blocks = []
+    load_document(io.BytesIO(ast)).walk(
+        lambda e, doc: blocks.append(e) if isinstance(e, CodeBlock) else None)
+    return blocks
+
+
+def named(blocks):
+    return [(b.identifier, list(b.classes), dict(b.attributes), b.text)
+            for b in blocks if b.identifier or "file" in b.attributes]
+
+
+def test_parse_attributes():
+    assert parse_attributes("{.python #a:b.c file=src/x.py}") == \
+        ("a:b.c", ["python"], {"file": "src/x.py"})
+    assert parse_attributes("{ #a #b - k='x y' }") == ("b", ["unnumbered"], {"k": "x y"})
+    assert parse_attributes("{.python #a/b}") is None
+    assert parse_attributes("{.1x}") is None
+    assert parse_attributes("{=html}") is None
+
+
+@pytest.mark.parametrize("path", [res / "tricky.md", res / "hello.md",
+                                  root / "lit" / "filters.md"])
+def test_same_as_pandoc(path):
+    with open(path, encoding="utf-8") as f:
+        assert named(code_blocks(f)) == named(pandoc_code_blocks(path))
+
+
+def test_tangle_md(tmp_path):
+    sources = [root / "lit" / "filters.md", res / "hello.md"]
+    file_map = get_file_map(read_code_map(sources))
+    for name in ["pandoc", "scanner"]:
+        for f in file_map:
+            (tmp_path / name / f).parent.mkdir(parents=True, exist_ok=True)
+    run(["pandoc", "-t", "plain", "--filter", "pandoc-tangle"] + [str(p) for p in sources],
+        cwd=tmp_path / "pandoc", check=True, capture_output=True)
+    run(["pandoc-tangle-md"] + [str(p) for p in sources],
+        cwd=tmp_path / "scanner", check=True, capture_output=True)
+    assert "hello_world.cc" in file_map and "pandoc_entangled/markdown.py" in file_map
+    for f in file_map:
+        assert (tmp_path / "scanner" / f).read_bytes() == (tmp_path / "pandoc" / f).read_bytes()
+
+
+def test_fragment_location():
+    code_map = read_code_map([res / "hello.md"])
+    main = code_map["hello_world.cc"][0]
+    assert main.location == f"{res / 'hello.md'}:12"
+    assert get_file_map(code_map) == {"hello_world.cc": "hello_world.cc"}
+
+
+def test_nested_blocks(tmp_path):
+    from pandoc_entangled.tangle import InvalidDocument
+
+    path = res / "nested.md"
+    found = {b.identifier for b in pandoc_code_blocks(path)}
+    assert {"in-quote", "in-list", "shallow"} <= found
+    with pytest.raises(InvalidDocument) as e:
+        read_code_map([path])
+    assert [p.location for p in e.value.problems] == [f"{path}:3", f"{path}:9"]
+    assert "`in-quote`" in e.value.problems[0].message
+
+    result = run(["pandoc-tangle-md", str(path)], cwd=tmp_path, capture_output=True,
+                 encoding="utf-8")
+    assert result.returncode == 1
+    assert "pandoc-tangle" in result.stderr and "Traceback" not in result.stderr
+    assert not (tmp_path / "out.py").exists()
@@ -32,3 +32,174 @@ def test_missing(tmp_path):
         run(["pandoc", "-t", "plain", "--filter", "pandoc-tangle", "missing_ref.md"],
             cwd=tmp_path, check=True)
 
+
+def test_expander_memoizes():
+    from pandoc_entangled.tangle import CodeMap, Expander, Fragment
+
+    code_map = CodeMap()
+    code_map.add(Fragment("leaf", "x = 1"))
+    code_map.add(Fragment("main", "def f():\n    <<leaf>>\n<<leaf>>"))
+    expander = Expander(code_map)
+    assert expander.fragment("main") == "def f():\n    x = 1\nx = 1"
+    assert expander._cache["leaf"] == "x = 1"
+    code_map["leaf"][0].text = "x = 2"
+    assert expander.fragment("main") == "def f():\n    x = 1\nx = 1"
+
+def test_expander_cycle():
+    from pandoc_entangled.tangle import CodeMap, Expander, Fragment, CyclicReference
+
+    code_map = CodeMap()
+    code_map.add(Fragment("a", "<<b>>"))
+    code_map.add(Fragment("b", "  <<a>>"))
+    with pytest.raises(CyclicReference, match="`a` -> `b` -> `a`"):
+        Expander(code_map).fragment("a")
+
+def test_incremental(tmp_path, monkeypatch):
+    from panflute import convert_text
+    from pandoc_entangled import tangle
+
+    res = Path.resolve(Path(__file__)).parent
+    copyfile(res / "hello.md", tmp_path / "hello.md")
+    run(["pandoc", "-t", "plain", "--filter", "pandoc-tangle", "hello.md"],
+        cwd=tmp_path, check=True)
+    assert (tmp_path / ".entangled" / "tangle-index.json").exists()
+
+    monkeypatch.chdir(tmp_path)
+    doc = convert_text((tmp_path / "hello.md").read_text(), standalone=True)
+    tangle.prepare(doc)
+    doc = doc.walk(tangle.action)
+
+    def fail(self, name):
+        raise AssertionError(f"`{name}` should not be expanded")
+    monkeypatch.setattr(tangle.Expander, "lines", fail)
+    tangle.finalize(doc)
+
+    (tmp_path / "hello_world.cc").write_text("garbage")
+    monkeypatch.undo()
+    monkeypatch.chdir(tmp_path)
+    tangle.finalize(doc)
+    assert (tmp_path / "hello_world.cc").read_text() == (res / "hello_world.cc").read_text()
+
+def test_update_file(tmp_path, monkeypatch):
+    import builtins
+    from pandoc_entangled import tangle
+
+    path = tmp_path / "out.txt"
+    assert tangle.update_file(str(path), ["hello", ""])
+    path.chmod(0o755)
+    assert tangle.update_file(str(path), ["world", ""])
+    assert path.read_bytes() == b"world\n"
+    assert path.stat().st_mode & 0o777 == 0o755
+
+    opened = []
+    def recording_open(file, mode="r", *args, **kwargs):
+        opened.append(mode)
+        return builtins.open(file, mode, *args, **kwargs)
+    monkeypatch.setattr(tangle, "open", recording_open, raising=False)
+    assert not tangle.update_file(str(path), ["world", ""])
+    assert opened == ["rb"]
+
+    lines = [f"line {i}" for i in range(100)]
+    for new in [lines[:50] + ["changed"] + lines[51:], lines[:60], lines + ["more"]]:
+        tangle.update_file(str(path), lines, chunk_size=7)
+        assert tangle.update_file(str(path), new, chunk_size=7)
+        assert path.read_text() == "\n".join(new)
+    assert list(tmp_path.iterdir()) == [path]
+
+def test_expander_lines():
+    from pandoc_entangled.tangle import CodeMap, Expander, Fragment
+
+    code_map = CodeMap()
+    code_map.add(Fragment("leaf", "x = 1\n\n  \ty = 2"))
+    code_map.add(Fragment("leaf", ""))
+    code_map.add(Fragment("mid", "if x:\n\t<<leaf>>\n  <<leaf>>"))
+    code_map.add(Fragment("main", "def f():\n    <<mid>>\n<<leaf>>\n"))
+    for name in code_map:
+        assert "\n".join(Expander(code_map).lines(name)) == Expander(code_map).fragment(name)
+    expander = Expander(code_map)
+    expander.fragment("mid")
+    assert "\n".join(expander.lines("main")) == Expander(code_map).fragment("main")
+
+def test_streaming_memory(tmp_path):
+    import tracemalloc
+    from pandoc_entangled.tangle import (CodeMap, Expander, Fragment, update_file)
+
+    code_map = CodeMap()
+    code_map.add(Fragment("leaf", "\n".join(f"line_{i} = {'x' * 80}" for i in range(1000))))
+    code_map.add(Fragment("main", "\n".join("    <<leaf>>" for _ in range(200))))
+    tracemalloc.start()
+    try:
+        update_file(str(tmp_path / "big.py"), Expander(code_map).lines("main"))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    size = (tmp_path / "big.py").stat().st_size
+    assert size > 18_000_000
+    assert peak < size / 10
+
+def test_write_report(tmp_path, monkeypatch, capsys):
+    from panflute import Doc
+    from pandoc_entangled import tangle
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("ENTANGLED_CACHE_DIR", str(tmp_path / "cache"))
+    def files(first):
+        doc = Doc()
+        doc.code_map = tangle.CodeMap()
+        for i in range(20):
+            text = first if i == 0 else f"{i}"
+            doc.code_map.add(tangle.Fragment(f"f{i}.txt", text, file=f"f{i}.txt"))
+        return doc
+
+    tangle.write_files(files("0"))
+    assert "20 written, 0 unchanged" in capsys.readouterr().err
+    assert all((tmp_path / f"f{i}.txt").read_text() == f"{i}" for i in range(20))
+
+    (tmp_path / "f1.txt").write_text("1")
+    tangle.write_files(files("changed"))
+    assert "1 written, 19 unchanged" in capsys.readouterr().err
+
+def test_code_map_fragments():
+    import io
+    from panflute import CodeBlock
+    from pandoc_entangled import tangle
+    from pandoc_entangled.document import load_document
+
+    res = Path.resolve(Path(__file__)).parent
+    ast = run(["pandoc", "-f", "markdown", "-t", "json", str(res / "hello.md")],
+              capture_output=True, check=True).stdout
+    doc = load_document(io.BytesIO(ast))
+    doc.source = "hello.md"
+    tangle.prepare(doc)
+    doc.walk(tangle.action)
+    fragments = [f for blocks in doc.code_map.values() for f in blocks]
+    assert fragments and all(type(f) is tangle.Fragment for f in fragments)
+    assert not hasattr(fragments[0], "__dict__")
+    assert tangle.get_file_map(doc.code_map) == {"hello_world.cc": "hello_world.cc"}
+    main = doc.code_map["hello_world.cc"][0]
+    assert (main.language, main.file, main.location) == ("cpp", "hello_world.cc", "hello.md «hello_world.cc»")
+    assert main.text == next(e.text for e in doc.content
+                             if isinstance(e, CodeBlock) and "file" in e.attributes)
+
+def test_validate_before_writing(tmp_path, monkeypatch):
+    from panflute import Doc
+    from pandoc_entangled import tangle
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("ENTANGLED_CACHE_DIR", str(tmp_path / "cache"))
+    doc = Doc()
+    doc.code_map = tangle.CodeMap()
+    doc.code_map.add(tangle.Fragment("a.txt", "<<x>>", file="a.txt", source="a.md", line=1))
+    doc.code_map.add(tangle.Fragment("b.txt", "b\n<<y>>\n<<b.txt>>", file="b.txt",
+                                     source="b.md", line=10))
+    doc.code_map.add(tangle.Fragment("ok.txt", "fine", file="ok.txt"))
+    doc.code_map.add(tangle.Fragment("c.txt", "<<w>>", file="c.txt"))
+    doc.code_map.add(tangle.Fragment("unused", "<<z>>"))
+    with pytest.raises(tangle.InvalidDocument) as e:
+        tangle.write_files(doc)
+    assert [str(p) for p in e.value.problems] == [
+        "a.md:2: No code with name `x` found, in `a.txt`.",
+        "b.md:12: No code with name `y` found, in `b.txt`.",
+        "b.md:13: Cyclic reference: `b.txt` -> `b.txt`.",
+        "«c.txt»: No code with name `w` found, in `c.txt`."]
+    assert not (tmp_path / "ok.txt").exists()